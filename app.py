@@ -3,21 +3,46 @@
 Streamlit Webアプリ (1ファイル構成)
 """
 
+import codecs
+import contextvars
+import gzip
+import hashlib
+import http.client
+import importlib
 import io
 import json
+import logging
+import multiprocessing
 import os
 import re
-from datetime import datetime, timedelta
-from urllib.error import URLError
-from urllib.request import Request, urlopen
-
+import sqlite3
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
 from dotenv import load_dotenv
+from python_calamine import CalamineWorkbook
 
 load_dotenv()
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import WriteOnlyCell
+from openpyxl.formatting.rule import FormulaRule
 from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 
 # ---------------------------------------------------------------------------
@@ -31,6 +56,19 @@ AGING_BINS = [
     (181, 365, "181-365日"),
     (366, 999999, "365日超"),
 ]
+AGING_LABELS = [label for _, _, label in AGING_BINS]
+
+# 期限ステータスの並び順（緊急度の高い順、期限なしは最後）
+EXPIRY_STATUSES = ["期限切れ", "3ヶ月以内", "期限あり", ""]
+
+# 在庫リストの必須カラムと、分析で使う任意カラム
+INVENTORY_REQUIRED_COLUMNS = ["Product Code", "PICKING KEY7", "Arrival Date", "Sub Inventory"]
+INVENTORY_OPTIONAL_COLUMNS = [
+    "Product Name", "PICKING KEY1",
+    "Total Piece Qty", "Case Qty", "Total Weight", "Total Volume",
+]
+# Excel シリアル値の起点（1900 年のうるう年バグを含めた 1899-12-30）
+EXCEL_EPOCH = "1899-12-30"
 
 SHOPEE_COLUMNS = [
     "Product ID", "Product Name", "Variation ID", "Variation Name",
@@ -38,6 +76,16 @@ SHOPEE_COLUMNS = [
     "Min Purchase Qty", "Fail Reason",
 ]
 
+# Shopee 掲載判定で一致したルール（判定順）。GTIN正規化 は GTIN-14 に揃えたコードでの一致
+SHOPEE_MATCH_REASONS = ["KEY1→SKU", "Code→GTIN", "バーコード", "GTIN正規化"]
+# 明細の match_reason の型。判定順の順序付きカテゴリで、一致なし（""）を最後に置き、
+# 商品ごとの min が最も優先のルールになるようにする
+MATCH_REASON_DTYPE = pd.CategoricalDtype(SHOPEE_MATCH_REASONS + [""], ordered=True)
+
+# GTIN として受け付ける桁数（先頭 0 が落ちた UPC-A・EAN-13 を含む）。正規形は 0 埋めした GTIN-14
+GTIN_MIN_DIGITS = 8
+GTIN_DIGITS = 14
+
 # Excel スタイル
 FILL_SHOPEE = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
 FILL_EXPIRED = PatternFill(start_color="FF6B6B", end_color="FF6B6B", fill_type="solid")
@@ -54,6 +102,80 @@ THIN_BORDER = Border(
     top=Side(style="thin"),
     bottom=Side(style="thin"),
 )
+# 明細行の塗り分け種別 → (塗りつぶし, フォント)
+ROW_FILL_STYLES = {
+    "shopee": (FILL_SHOPEE, None),
+    "expired": (FILL_EXPIRED, FONT_EXPIRED),
+    "near": (FILL_NEAR_EXPIRY, None),
+    "green": (FILL_GREEN, None),
+    "yellow": (FILL_YELLOW, None),
+    "pink": (FILL_PINK, None),
+}
+SUMMARY_HEADERS = ["Agingカテゴリ", "SKU数", "Shopee掲載数", "合計数量", "期限注意", "構成比(%)"]
+
+# この行数以上の結果は write_only モードで Excel を書き出す
+EXCEL_STREAMING_THRESHOLD = int(os.getenv("EXCEL_STREAMING_THRESHOLD", "20000"))
+# 列幅の計算はこの行数までを対象にし、それ以上のシートは抽出した行で見積もる
+EXCEL_WIDTH_SAMPLE_ROWS = 100_000
+
+# アップロードファイル解析キャッシュの上限（件数・合計メモリ）
+PARSE_CACHE_MAX_ENTRIES = 32
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Shopee ファイルを並列に読み込むスレッド数（在庫リストは別スレッドで同時に読む）
+LOAD_WORKERS = max(1, int(os.getenv("LOAD_WORKERS", str(min(8, os.cpu_count() or 1)))))
+
+# 複数の在庫リスト（倉庫ごとのエクスポート）を読み込み・部分集計するプロセス数
+INVENTORY_WORKERS = max(1, int(os.getenv("INVENTORY_WORKERS", str(os.cpu_count() or 1))))
+
+# 行単位の読込（大容量の在庫リスト向け）で使うエンジン。openpyxl はシートを少しずつ読むため
+# メモリが EC 対象の行数で決まる。calamine は数倍速いがシート全体をネイティブメモリに展開する
+INVENTORY_STREAM_ENGINE = os.getenv("INVENTORY_STREAM_ENGINE", "openpyxl")
+
+# 解析結果を Parquet で保存するディスクキャッシュ（合計サイズ・保持日数の上限）
+PARSE_DISK_CACHE_DIR = os.getenv(
+    "PARSE_DISK_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "parsed"),
+)
+PARSE_DISK_CACHE_MAX_BYTES = int(os.getenv("PARSE_DISK_CACHE_MAX_MB", "2048")) * 1024 * 1024
+PARSE_DISK_CACHE_MAX_AGE_DAYS = float(os.getenv("PARSE_DISK_CACHE_MAX_AGE_DAYS", "7"))
+
+# 分析結果の履歴（日付 × Product Code）を保存する SQLite データベース
+SNAPSHOT_DB_PATH = os.getenv(
+    "SNAPSHOT_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "snapshots.sqlite3"),
+)
+
+# 取り込んだ Shopee 商品（SKU/GTIN/バーコード）を蓄積するカタログ
+SHOPEE_CATALOG_DB_PATH = os.getenv(
+    "SHOPEE_CATALOG_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "shopee_catalog.sqlite3"),
+)
+
+# 段階ごとの計測。tracemalloc のピーク計測は Python オブジェクトを多く作る処理（Excel 出力など）を
+# 数倍遅くするため、既定では時間だけを測る（1 でメモリも計測）
+PERF_TRACE_MEMORY = os.getenv("PERF_TRACE_MEMORY", "0") == "1"
+# 計測結果の JSON ログ（1行1回）の出力先。空なら標準エラーに出す
+PERF_LOG_PATH = os.getenv("PERF_LOG_PATH", "")
+
+# CSV はこの行数ずつ表記を変換して書き出す（ピークメモリは結果＋1チャンク分）
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "50000"))
+
+# Excel/CSV 出力キャッシュの上限（件数・合計サイズ）
+EXPORT_CACHE_MAX_ENTRIES = 16
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# Slack API の URL（テスト用の偽サーバーに向けられる）と、送信箱・再送の設定
+SLACK_API_BASE = os.getenv("SLACK_API_BASE", "https://slack.com/api")
+SLACK_OUTBOX_DB_PATH = os.getenv(
+    "SLACK_OUTBOX_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "slack_outbox.sqlite3"),
+)
+SLACK_MAX_ATTEMPTS = int(os.getenv("SLACK_MAX_ATTEMPTS", "5"))
+SLACK_RETRY_BACKOFF = float(os.getenv("SLACK_RETRY_BACKOFF", "2"))
+SLACK_RETRY_MAX_DELAY = 300.0
+# 送信箱に残す完了済み（送信済み・失敗）ジョブの件数
+SLACK_OUTBOX_KEEP = 50
 
 # ---------------------------------------------------------------------------
 # カスタム CSS
@@ -317,6 +439,17 @@ def parse_expiry(sub_inv: str) -> pd.Timestamp | None:
         return None
 
 
+def parse_expiry_column(sub_inv: pd.Series) -> pd.Series:
+    """parse_expiry の列版。ユニーク値だけを解析し、コード経由で全行に展開する。"""
+    codes, uniques = pd.factorize(sub_inv)
+    digits = pd.Series(uniques, dtype=object).str.extract(r"SS?_(\d{6})$", expand=False)
+    # %y は 69 以上を 1900 年代と解釈するため、世紀を付けて %Y で解析する
+    parsed = pd.to_datetime("20" + digits, format="%Y%m%d", errors="coerce")
+    # 欠損値のコード -1 が末尾の NaT を指すよう 1 要素足しておく
+    values = np.append(parsed.to_numpy(dtype="datetime64[us]"), np.datetime64("NaT", "us"))
+    return pd.Series(values[codes], index=sub_inv.index)
+
+
 def expiry_status(earliest_expiry: pd.Timestamp | None, today: pd.Timestamp) -> str:
     if earliest_expiry is None or pd.isna(earliest_expiry):
         return ""
@@ -327,71 +460,669 @@ def expiry_status(earliest_expiry: pd.Timestamp | None, today: pd.Timestamp) ->
     return "期限あり"
 
 
+def categorize_aging_column(days: pd.Series) -> pd.Series:
+    """categorize_aging の列版。AGING_BINS 順の順序付きカテゴリで返す。"""
+    lows = np.array([lo for lo, _, _ in AGING_BINS])
+    highs = np.array([hi for _, hi, _ in AGING_BINS])
+    values = days.to_numpy()
+    idx = np.searchsorted(highs, values, side="left")
+    # どのビンにも入らない値（負の日数など）は categorize_aging と同じく「365日超」
+    in_bin = idx < len(AGING_BINS)
+    in_bin[in_bin] &= values[in_bin] >= lows[idx[in_bin]]
+    codes = np.where(in_bin, idx, AGING_LABELS.index("365日超"))
+    dtype = pd.CategoricalDtype(AGING_LABELS, ordered=True)
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=days.index)
+
+
+def expiry_status_column(earliest_expiry: pd.Series, today: pd.Timestamp) -> pd.Series:
+    """expiry_status の列版。EXPIRY_STATUSES 順の順序付きカテゴリで返す。"""
+    status = np.select(
+        [
+            earliest_expiry.isna(),
+            earliest_expiry <= today,
+            earliest_expiry <= today + timedelta(days=90),
+        ],
+        ["", "期限切れ", "3ヶ月以内"],
+        default="期限あり",
+    )
+    dtype = pd.CategoricalDtype(EXPIRY_STATUSES, ordered=True)
+    return pd.Series(pd.Categorical(status, dtype=dtype), index=earliest_expiry.index)
+
+
 def strip_leading_zeros(s: str) -> str:
     return s.lstrip("0")
 
 
+def _integral_text(text: str) -> str:
+    """Excel 由来の "4901234567890.0" や "4.90123456789E+12" を整数の文字列に戻す。"""
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        return text
+    return str(int(value)) if value.is_finite() and value == value.to_integral_value() else text
+
+
+def canonical_gtin_column(values: pd.Series) -> pd.DataFrame:
+    """コードを GTIN-14 の正規形に揃え、gtin と reason の列を返す。
+
+    空白・ハイフンと小数表記を取り除き、8〜14 桁の数字を 14 桁に 0 埋めしてチェックデジットを
+    検証する。EAN-13・UPC-A・GTIN-8・GTIN-14 で書かれた同じ商品は同じキーになる。
+    検証に落ちたコードは gtin が欠損で reason に理由が入る（空欄は理由なし）。ユニーク値だけを処理する。
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    # Arrow 文字列にして正規表現を列単位で適用する（数値は str(x) と同じ表記になる）
+    text = pd.Series(uniques, dtype=object).astype("str").fillna("")
+    text = text.str.replace(r"[\s\-]", "", regex=True)
+    decimal = text.str.fullmatch(r"\d+\.\d*(?:[eE][+-]?\d+)?|\d+[eE]\+?\d+")
+    if decimal.any():
+        text[decimal] = text[decimal].map(_integral_text)
+
+    digits = text.str.fullmatch(r"\d+")
+    sized = digits & text.str.len().between(GTIN_MIN_DIGITS, GTIN_DIGITS)
+    padded = text[sized].str.zfill(GTIN_DIGITS)
+    matrix = (
+        np.frombuffer(padded.str.cat().encode("ascii") if len(padded) else b"", dtype=np.uint8).reshape(-1, GTIN_DIGITS).astype(np.int64)
+        - ord("0")
+    )
+    # チェックデジットは右から2桁目を 3 倍として交互に重み付けした和の 10 の補数
+    weights = np.tile([3, 1], GTIN_DIGITS // 2)[:-1]
+    check_ok = (10 - matrix[:, :-1] @ weights % 10) % 10 == matrix[:, -1]
+    gtin = pd.Series(np.nan, index=text.index, dtype=object)
+    gtin[sized] = padded.where(check_ok)
+
+    reason = np.select(
+        [text == "", ~digits, ~sized, gtin.isna()],
+        ["", "数字以外を含む", f"桁数が {GTIN_MIN_DIGITS}〜{GTIN_DIGITS} 桁でない", "チェックデジット不一致"],
+        default="",
+    ).astype(object)
+    return pd.DataFrame(
+        {"gtin": gtin.to_numpy()[codes], "reason": reason[codes]}, index=values.index,
+    )
+
+
+def canonical_gtin(code) -> str | None:
+    """canonical_gtin_column の1件版。検証に落ちたコードは None。"""
+    gtin = canonical_gtin_column(pd.Series([code], dtype=object))["gtin"].iloc[0]
+    return None if pd.isna(gtin) else gtin
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+class StageTimer:
+    """段階ごとの実行時間・行数・tracemalloc のピーク（段階開始時からの増分）を記録する。
+
+    段階は入れ子にでき、内側の段階でピークをリセットしても外側のピークには反映される。
+    """
+
+    def __init__(self, trace_memory: bool = PERF_TRACE_MEMORY):
+        self.trace_memory = trace_memory
+        self.records: list[dict] = []
+        self.context: dict = {}
+        self._stack: list[dict] = []
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str, rows: int | None = None):
+        record = {"stage": name, "depth": len(self._stack), "rows": rows, "seconds": None, "peak_mb": None}
+        self.records.append(record)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            for parent in self._stack:
+                parent["_peak"] = max(parent["_peak"], peak)
+            tracemalloc.reset_peak()
+            record["_start"] = record["_peak"] = current
+        self._stack.append(record)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - t0, 4)
+            self._stack.pop()
+            if "_start" in record:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(record.pop("_peak"), peak)
+                for parent in self._stack:
+                    parent["_peak"] = max(parent["_peak"], peak)
+                record["peak_mb"] = round((peak - record.pop("_start")) / 1024 / 1024, 1)
+            if not self._stack and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def merge(self, records: list[dict]):
+        """別プロセスで計測した段階を、実行中の段階の内側として取り込む。"""
+        depth = len(self._stack)
+        self.records.extend({**record, "depth": record["depth"] + depth} for record in records)
+
+    def total_seconds(self) -> float:
+        return round(sum(r["seconds"] or 0 for r in self.records if r["depth"] == 0), 4)
+
+
+_active_timer: contextvars.ContextVar[StageTimer | None] = contextvars.ContextVar("active_timer", default=None)
+
+
+@contextmanager
+def perf_stage(name: str, rows: int | None = None):
+    """計測中（main の実行中）なら段階として記録する。返す dict の "rows" は後から設定してよい。
+
+    スレッドプールのワーカーでは計測しない（コンテキストが引き継がれないため）。
+    """
+    timer = _active_timer.get()
+    if timer is None:
+        yield {}
+        return
+    with timer.stage(name, rows) as record:
+        yield record
+
+
+def _perf_logger() -> logging.Logger:
+    logger = logging.getLogger("inventory_aging.perf")
+    if not logger.handlers:
+        handler = logging.FileHandler(PERF_LOG_PATH, encoding="utf-8") if PERF_LOG_PATH else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def log_perf(timer: StageTimer):
+    """計測結果を1行の JSON としてログに出す。"""
+    _perf_logger().info(json.dumps({
+        "event": "perf",
+        "at": datetime.now().isoformat(timespec="seconds"),
+        **timer.context,
+        "total_seconds": timer.total_seconds(),
+        "stages": timer.records,
+    }, ensure_ascii=False, default=str))
+
+
+# ---------------------------------------------------------------------------
+# キャッシュ
+# ---------------------------------------------------------------------------
+class LRUCache:
+    """件数と合計サイズで上限を管理する、スレッドセーフな LRU キャッシュ。
+
+    sizeof で値のサイズ（バイト）を求める。既定は len（bytes 向け）。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[object, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+
+def _frame_nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+@st.cache_resource
+def _parse_cache() -> LRUCache:
+    """アップロードファイルの解析結果キャッシュ（全セッション共有）。"""
+    return LRUCache(PARSE_CACHE_MAX_ENTRIES, PARSE_CACHE_MAX_BYTES, sizeof=_frame_nbytes)
+
+
+def _file_bytes(file) -> bytes:
+    """UploadedFile / パス / ファイルオブジェクトから内容を取り出す。"""
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as fh:
+            return fh.read()
+    data = file.read()
+    if hasattr(file, "seek"):
+        file.seek(0)
+    return data
+
+
+def _disk_cache_path(key: tuple) -> str:
+    name = hashlib.sha256(repr(key).encode()).hexdigest()
+    return os.path.join(PARSE_DISK_CACHE_DIR, f"{name}.parquet")
+
+
+def _disk_cache_files() -> list[os.DirEntry]:
+    if not os.path.isdir(PARSE_DISK_CACHE_DIR):
+        return []
+    return [e for e in os.scandir(PARSE_DISK_CACHE_DIR) if e.name.endswith(".parquet")]
+
+
+def _disk_cache_load(key: tuple) -> pd.DataFrame | None:
+    path = _disk_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        table = pq.read_table(path)
+        columns = json.loads(table.schema.metadata[b"source_columns"])
+        df = table.to_pandas()
+        df.columns = columns
+    except Exception:
+        return None
+    # 最終利用時刻を更新し、サイズ超過時の削除順（古い順）に反映させる
+    os.utime(path)
+    return df
+
+
+def _disk_cache_store(key: tuple, df: pd.DataFrame):
+    """解析結果を Parquet で保存する。Arrow に変換できない列（型の混在など）があれば保存しない。"""
+    try:
+        # Parquet の列名は文字列のみなので、元の列名（数値を含む）はメタデータに残す
+        table = pa.Table.from_pandas(
+            df.set_axis([str(i) for i in range(len(df.columns))], axis=1), preserve_index=False,
+        )
+        metadata = {**(table.schema.metadata or {}), b"source_columns": json.dumps(list(df.columns)).encode()}
+        os.makedirs(PARSE_DISK_CACHE_DIR, exist_ok=True)
+        path = _disk_cache_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        return
+    _prune_disk_cache()
+
+
+def _prune_disk_cache():
+    """保持日数を過ぎたファイルを削除し、合計サイズが上限を超えていれば古い順に削除する。"""
+    now = datetime.now().timestamp()
+    max_age = PARSE_DISK_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    files = []
+    for entry in _disk_cache_files():
+        try:
+            stat = entry.stat()
+            if now - stat.st_mtime > max_age:
+                os.remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= PARSE_DISK_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            continue
+
+
+def disk_cache_stats() -> dict:
+    sizes = []
+    for entry in _disk_cache_files():
+        try:
+            sizes.append(entry.stat().st_size)
+        except OSError:
+            continue
+    return {"files": len(sizes), "bytes": sum(sizes)}
+
+
+def clear_parse_caches():
+    """解析キャッシュ（メモリ・ディスク）をすべて削除する。"""
+    _parse_cache().clear()
+    for entry in _disk_cache_files():
+        try:
+            os.remove(entry.path)
+        except OSError:
+            continue
+
+
+def read_excel_cached(file, **read_kwargs) -> pd.DataFrame:
+    """pd.read_excel の結果を、ファイル内容のハッシュと読み込み設定をキーに再利用する。
+
+    メモリ上の LRU → ディスク上の Parquet → Excel の解析、の順に探す。
+    キャッシュ上の DataFrame は共有されるため、呼び出し側には浅いコピーを返す。
+    """
+    data = _file_bytes(file)
+    # 関数は再実行ごとに作り直されるため、キーには名前を使う
+    settings = sorted((k, getattr(v, "__qualname__", v)) for k, v in read_kwargs.items())
+    return _cached_parse(data, settings, lambda: pd.read_excel(io.BytesIO(data), **read_kwargs))
+
+
+def _cached_parse(data: bytes, settings, parse) -> pd.DataFrame:
+    """ファイル内容のハッシュと設定をキーに、parse() の結果を LRU とディスクにキャッシュする。"""
+    key = (hashlib.sha256(data).hexdigest(), repr(settings))
+    cache = _parse_cache()
+    df = cache.get(key)
+    if df is None:
+        df = _disk_cache_load(key)
+        if df is None:
+            df = parse()
+            _disk_cache_store(key, df)
+        cache.put(key, df)
+    return df.copy(deep=False)
+
+
 # ---------------------------------------------------------------------------
 # データ読み込み
 # ---------------------------------------------------------------------------
+def _is_inventory_column(name) -> bool:
+    return name in INVENTORY_REQUIRED_COLUMNS or name in INVENTORY_OPTIONAL_COLUMNS
+
+
+def is_ec_key7(values, include_blank_key7: bool = False) -> np.ndarray:
+    """PICKING KEY7 の値が分析対象（EC、include_blank_key7 なら空欄も）かどうか。"""
+    # 欠損は astype(str) でも欠損のまま残る（pandas 3）ため、先に空文字にしておく
+    key7 = pd.Series(values, dtype=object).fillna("").astype(str).str.strip().str.upper()
+    if include_blank_key7:
+        return ((key7 == "EC") | key7.isin(["", "NAN", "NONE"])).to_numpy(dtype=bool)
+    return (key7 == "EC").to_numpy(dtype=bool)
+
+
+def _read_inventory_fast(file) -> pd.DataFrame:
+    """calamine で分析に使う列だけを読み込む高速パス。
+
+    コード列は文字列として読み、先頭の 0 を保持する。Arrival Date が数値
+    （日付書式のない Excel シリアル値）の場合はそのまま日付に変換する。
+    """
+    df = read_excel_cached(
+        file,
+        engine="calamine",
+        usecols=_is_inventory_column,
+        dtype={"Product Code": str, "PICKING KEY1": str},
+    )
+    arrival = df.get("Arrival Date")
+    if arrival is not None and pd.api.types.is_numeric_dtype(arrival) and not pd.api.types.is_bool_dtype(arrival):
+        df["Arrival Date"] = pd.to_datetime(arrival, unit="D", origin=EXCEL_EPOCH)
+    return df
+
+
 def load_inventory(file) -> pd.DataFrame:
+    # 高速パスで読めない・必要なカラムが揃わない場合は、従来どおり全列を openpyxl で読む
+    try:
+        df = _read_inventory_fast(file)
+        if any(c not in df.columns for c in INVENTORY_REQUIRED_COLUMNS):
+            df = None
+    except Exception:
+        df = None
+    if df is None:
+        try:
+            # 高速パスと同じくキーは文字列で読む（先頭の 0 を落とさない）
+            df = read_excel_cached(file, engine="openpyxl", dtype={"Product Code": str, "PICKING KEY1": str})
+        except Exception as e:
+            raise ValueError(
+                f"在庫リストの読み込みに失敗しました。\n"
+                f"Excel形式（.xlsx）のファイルを指定してください。\n"
+                f"詳細: {e}"
+            )
+    missing = [c for c in INVENTORY_REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(
+            f"在庫リストに必要なカラムが見つかりません: {', '.join(missing)}\n"
+            f"1行目がヘッダー行のExcelファイルか確認してください。"
+        )
+    return df
+
+
+class _ColumnBuffer:
+    """1 列分のセル値を辞書符号化で貯める。
+
+    同じ値は 1 つのオブジェクトを共有し、行ごとには 4 バイトのコードだけを持つ。
+    型の変換（整数値の float → int、date → Timestamp など）はユニーク値に対してだけ行う。
+    """
+
+    __slots__ = ("codes", "index", "values")
+
+    def __init__(self):
+        self.codes = array("i")
+        self.index: dict = {}
+        self.values: list = []
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def to_series(self, as_code: bool = False) -> pd.Series:
+        if as_code:
+            # コード列は文字列として扱い、先頭の 0 を保持する（数値セルは整数表記にする）
+            uniques = [
+                None if v is None else str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)
+                for v in self.values
+            ]
+            uniques = pd.Series(uniques, dtype="str")
+        else:
+            uniques = pd.Series(self.values, dtype=object).infer_objects()
+        codes = np.frombuffer(self.codes, dtype=np.int32) if self.codes else np.empty(0, dtype=np.int32)
+        return uniques.take(codes).reset_index(drop=True)
+
+
+def _cell_value(value):
+    """read_excel と同じく、空文字は欠損に、整数値の float は int に、日付は日時にそろえる。"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, float):
+        if value != value:
+            return None
+        return int(value) if value.is_integer() else value
+    if type(value) is date:
+        return datetime(value.year, value.month, value.day)
+    return value
+
+
+def _iter_sheet_rows(data: bytes, engine: str):
+    """先頭シートの行を値のタプル（リスト）として1行ずつ返す。"""
+    if engine == "calamine":
+        sheet = CalamineWorkbook.from_filelike(io.BytesIO(data)).get_sheet_by_index(0)
+        yield from sheet.iter_rows()
+        return
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _stream_inventory(data: bytes, include_blank_key7: bool, engine: str) -> pd.DataFrame:
+    rows = _iter_sheet_rows(data, engine)
+    header = next(rows, None) or []
+    positions = {}
+    for i, name in enumerate(header):
+        if _is_inventory_column(name) and name not in positions:
+            positions[name] = i
+    missing = [c for c in INVENTORY_REQUIRED_COLUMNS if c not in positions]
+    if missing:
+        raise ValueError(
+            f"在庫リストに必要なカラムが見つかりません: {', '.join(missing)}\n"
+            f"1行目がヘッダー行のExcelファイルか確認してください。"
+        )
+    buffers = {name: _ColumnBuffer() for name in positions}
+    columns = [(buffers[name], i) for name, i in positions.items()]
+    key7_pos = positions["PICKING KEY7"]
+    # KEY7 の判定はユニーク値ごとに1回だけ行う
+    targets: dict = {}
+    for row in rows:
+        key7 = _cell_value(row[key7_pos]) if key7_pos < len(row) else None
+        target = targets.get(key7)
+        if target is None:
+            target = targets[key7] = bool(is_ec_key7([key7], include_blank_key7)[0])
+        if not target:
+            continue
+        # 完全な空行は read_excel と同じく読み飛ばす（KEY7 が空欄の行だけ確認すればよい）
+        if key7 is None and all(v is None or v == "" for v in row):
+            continue
+        for buf, i in columns:
+            buf.append(_cell_value(row[i]) if i < len(row) else None)
+    df = pd.DataFrame({
+        name: buffers.pop(name).to_series(as_code=name in ("Product Code", "PICKING KEY1"))
+        for name in list(positions)
+    })
+    arrival = df["Arrival Date"]
+    if pd.api.types.is_numeric_dtype(arrival) and not pd.api.types.is_bool_dtype(arrival):
+        df["Arrival Date"] = pd.to_datetime(arrival, unit="D", origin=EXCEL_EPOCH)
+    return df
+
+
+def load_inventory_streaming(
+    file, include_blank_key7: bool = False, engine: str = INVENTORY_STREAM_ENGINE,
+) -> pd.DataFrame:
+    """在庫リストを1行ずつ読み、EC 対象の行の分析に使う列だけを DataFrame にする。
+
+    全チャネル分の大きなエクスポートでも、メモリは EC 対象の行数で決まる（engine="openpyxl"）。
+    結果は通常の読み込みと同じ解析キャッシュに、KEY7 の条件ごとに保存する。
+    """
+    data = _file_bytes(file)
+    settings = [("mode", "stream"), ("include_blank_key7", include_blank_key7), ("engine", engine)]
     try:
-        df = pd.read_excel(file, engine="openpyxl")
+        return _cached_parse(data, settings, lambda: _stream_inventory(data, include_blank_key7, engine))
+    except ValueError:
+        raise
     except Exception as e:
         raise ValueError(
             f"在庫リストの読み込みに失敗しました。\n"
             f"Excel形式（.xlsx）のファイルを指定してください。\n"
             f"詳細: {e}"
         )
-    required = ["Product Code", "PICKING KEY7", "Arrival Date", "Sub Inventory"]
-    missing = [c for c in required if c not in df.columns]
-    if missing:
+
+
+def _read_shopee_file(f) -> pd.DataFrame:
+    try:
+        df = read_excel_cached(f, skiprows=3, header=None, engine="calamine")
+    except Exception as e:
         raise ValueError(
-            f"在庫リストに必要なカラムが見つかりません: {', '.join(missing)}\n"
-            f"1行目がヘッダー行のExcelファイルか確認してください。"
+            f"Shopeeファイル「{f.name}」の読み込みに失敗しました。\n"
+            f"Shopee管理画面からエクスポートしたExcelファイルか確認してください。\n"
+            f"詳細: {e}"
         )
+    if len(df.columns) >= len(SHOPEE_COLUMNS):
+        df = df.iloc[:, : len(SHOPEE_COLUMNS)]
+        df.columns = SHOPEE_COLUMNS
+    else:
+        df.columns = SHOPEE_COLUMNS[: len(df.columns)]
     return df
 
 
-def load_shopee_files(files) -> pd.DataFrame:
-    frames = []
-    for f in files:
-        try:
-            df = pd.read_excel(f, skiprows=3, header=None, engine="calamine")
-        except Exception as e:
-            raise ValueError(
-                f"Shopeeファイル「{f.name}」の読み込みに失敗しました。\n"
-                f"Shopee管理画面からエクスポートしたExcelファイルか確認してください。\n"
-                f"詳細: {e}"
-            )
-        if len(df.columns) >= len(SHOPEE_COLUMNS):
-            df = df.iloc[:, : len(SHOPEE_COLUMNS)]
-            df.columns = SHOPEE_COLUMNS
-        else:
-            df.columns = SHOPEE_COLUMNS[: len(df.columns)]
-        frames.append(df)
+def load_shopee_files(files, workers: int = LOAD_WORKERS, shops=None) -> pd.DataFrame:
+    """Shopee ファイルを並列に読み込み、アップロード順に結合する。
+
+    shops を渡すと、ファイルごとのショップ名を Shop 列に入れる（空欄のファイルは空文字）。
+    失敗したファイルが複数ある場合は、アップロード順で最初のファイルのエラーを返す。
+    """
+    files = list(files)
+    if workers <= 1 or len(files) <= 1:
+        frames = [_read_shopee_file(f) for f in files]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(files))) as pool:
+            futures = [pool.submit(_read_shopee_file, f) for f in files]
+            frames = [future.result() for future in futures]
+    if shops is not None:
+        for frame, shop in zip(frames, shops):
+            frame["Shop"] = (shop or "").strip()
     combined = pd.concat(frames, ignore_index=True)
     combined = combined.dropna(subset=["Product ID"])
     return combined
 
 
+def _run_now(func, *args) -> Future:
+    """func をその場で実行し、結果（または例外）を完了済みの Future に詰める。"""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def load_inputs(
+    inv_file, shopee_files, workers: int = LOAD_WORKERS, stream: bool = False, include_blank_key7: bool = False,
+    shopee_shops=None,
+) -> tuple[Future, Future | None]:
+    """在庫リストと Shopee ファイルを読み込み、(在庫, Shopee) の Future を返す。
+
+    shopee_shops は Shopee ファイルごとのショップ名（load_shopee_files の shops）。
+    workers > 1 なら在庫リストを別スレッドで読みつつ Shopee ファイルを並列に読む。
+    stream=True なら在庫リストを load_inventory_streaming で EC 対象の行だけ読む。
+    読み込みエラーは各 Future の result() で送出される（Shopee なしは None）。
+    """
+    load_inventory_file = (
+        partial(load_inventory_streaming, include_blank_key7=include_blank_key7) if stream else load_inventory
+    )
+    if workers <= 1:
+        inv_future = _run_now(load_inventory_file, inv_file)
+        if not shopee_files or inv_future.exception() is not None:
+            return inv_future, None
+        return inv_future, _run_now(load_shopee_files, shopee_files, 1, shopee_shops)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        inv_future = pool.submit(load_inventory_file, inv_file)
+        shopee_future = _run_now(load_shopee_files, shopee_files, workers, shopee_shops) if shopee_files else None
+    return inv_future, shopee_future
+
+
 # ---------------------------------------------------------------------------
 # Shopee 掲載判定
 # ---------------------------------------------------------------------------
+def _sku_barcodes(skus: pd.Series) -> pd.Series:
+    """SKU は「prefix_barcode_suffix」形式。先頭と末尾の "_" の間をバーコードとみなす。"""
+    return pd.Series(skus.unique(), dtype=object).str.extract(r"^[^_]*_(.*)_[^_]*$", expand=False).dropna()
+
+
+def _shopee_keys(shopee_df: pd.DataFrame) -> tuple[pd.Series, pd.Series, pd.Series, pd.Series]:
+    """Shopee 商品リストから SKU・GTIN・バーコード（先頭 0 なしを含む）と GTIN-14 キーを取り出す。
+
+    GTIN-14 キーは GTIN・SKU のバーコード・SKU そのものを canonical_gtin_column で正規化し、
+    検証を通ったものだけ。
+    """
+    skus = shopee_df["SKU"].dropna().astype(str).str.strip()
+    gtins = shopee_df["GTIN"].dropna().astype(str).str.strip()
+    barcodes = _sku_barcodes(skus)
+    codes = pd.concat([pd.Series(gtins.unique(), dtype=object), barcodes, pd.Series(skus.unique(), dtype=object)])
+    gtin14 = canonical_gtin_column(codes)["gtin"].dropna()
+    return skus, gtins, pd.concat([barcodes, barcodes.str.lstrip("0")], ignore_index=True), gtin14
+
+
 def build_shopee_sets(shopee_df: pd.DataFrame):
-    sku_set = set(shopee_df["SKU"].dropna().astype(str).str.strip())
-    gtin_set = set(shopee_df["GTIN"].dropna().astype(str).str.strip())
-    barcode_set: set[str] = set()
-    for sku in sku_set:
-        parts = sku.split("_")
-        if len(parts) >= 3:
-            barcode = "_".join(parts[1:-1])
-            barcode_set.add(barcode)
-            barcode_set.add(strip_leading_zeros(barcode))
-    return sku_set, gtin_set, barcode_set
-
-
-def is_on_shopee(row: pd.Series, sku_set: set, gtin_set: set, barcode_set: set) -> bool:
+    skus, gtins, barcodes, gtin14 = _shopee_keys(shopee_df)
+    return set(skus), set(gtins), set(barcodes), set(gtin14)
+
+
+def is_on_shopee(
+    row: pd.Series, sku_set: set, gtin_set: set, barcode_set: set, gtin14_set: set = frozenset(),
+) -> bool:
     pk1 = str(row.get("PICKING KEY1", "")).strip()
     pcode = str(row.get("Product Code", "")).strip()
     if pk1 and pk1 in sku_set:
@@ -400,43 +1131,218 @@ def is_on_shopee(row: pd.Series, sku_set: set, gtin_set: set, barcode_set: set)
         return True
     if pcode and (pcode in barcode_set or strip_leading_zeros(pcode) in barcode_set):
         return True
+    if pcode and canonical_gtin(pcode) in gtin14_set:
+        return True
     return False
 
 
-# ---------------------------------------------------------------------------
-# メイン分析処理
-# ---------------------------------------------------------------------------
-def run_analysis(
-    inv_df: pd.DataFrame,
-    shopee_df: pd.DataFrame | None,
-    include_blank_key7: bool = False,
-) -> pd.DataFrame:
-    today = pd.Timestamp(datetime.today().date())
-
-    key7 = inv_df["PICKING KEY7"].astype(str).str.strip().str.upper()
-    if include_blank_key7:
-        mask = (key7 == "EC") | (key7.isin(["", "NAN", "NONE"]))
+def gtin_validation_report(product_codes: pd.Series | None = None, shopee_df: pd.DataFrame | None = None) -> pd.DataFrame:
+    """GTIN-14 に正規化できなかったコードの一覧（区分・コード・理由・件数）。空欄は含めない。"""
+    sources = []
+    if product_codes is not None:
+        sources.append(("在庫 Product Code", product_codes))
+    if shopee_df is not None and not shopee_df.empty:
+        skus, gtins, _, _ = _shopee_keys(shopee_df)
+        sources.append(("Shopee GTIN", gtins))
+        sources.append(("Shopee SKU のバーコード", _sku_barcodes(skus)))
+    frames = []
+    for source, values in sources:
+        counts = values.dropna().astype(str).str.strip().value_counts(sort=False)
+        checked = canonical_gtin_column(pd.Series(counts.index, dtype=object))
+        failed = (checked["reason"] != "").to_numpy()
+        frames.append(pd.DataFrame({
+            "区分": source,
+            "コード": counts.index[failed],
+            "理由": checked["reason"].to_numpy()[failed],
+            "件数": counts.to_numpy()[failed],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=["区分", "コード", "理由", "件数"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _factorize_keys(values: pd.Series) -> tuple[np.ndarray, pd.Series]:
+    """列をユニーク値に分解し、str(x).strip() 相当のキー文字列を返す。"""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    if pd.api.types.is_string_dtype(uniques) and pd.api.types.infer_dtype(uniques, skipna=True) == "string":
+        # 文字列だけなら Arrow 文字列のまま strip する（欠損は str(nan) と同じ "nan"）
+        keys = pd.Series(uniques, dtype="str").str.strip().fillna("nan")
     else:
-        mask = key7 == "EC"
-    df = inv_df[mask].copy()
-    if df.empty:
-        st.error("対象レコードが見つかりません。PICKING KEY7 の値を確認してください。")
-        return pd.DataFrame()
+        keys = pd.Series([str(u).strip() for u in uniques], dtype=object)
+    return codes, keys
+
+
+SHOPEE_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shopee_catalog (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    shop TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    PRIMARY KEY (kind, key, shop)
+) WITHOUT ROWID;
+"""
 
-    df["賞味期限"] = df["Sub Inventory"].apply(parse_expiry)
 
-    if shopee_df is not None and not shopee_df.empty:
-        sku_set, gtin_set, barcode_set = build_shopee_sets(shopee_df)
-        df["Shopee掲載"] = df.apply(lambda r: is_on_shopee(r, sku_set, gtin_set, barcode_set), axis=1)
-    else:
-        df["Shopee掲載"] = False
+class ShopeeCatalog:
+    """取り込んだ Shopee 商品リストの SKU・GTIN・バーコードを SQLite に蓄積する。
+
+    キーは (種別, キー, ショップ) で、ショップを取り込むたびにそのショップの行を最新の
+    エクスポートで置き換える（掲載をやめた商品は判定に残らない）。
+    判定時は在庫側のキーだけを主キーの索引で引くため、カタログの件数によらず速い。
+    """
+
+    def __init__(self, path: str = SHOPEE_CATALOG_DB_PATH):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SHOPEE_CATALOG_SCHEMA)
+        return conn
+
+    def upsert(self, shopee_df: pd.DataFrame, seen_date: str | None = None) -> int:
+        """Shopee 商品リストでショップ（Shop 列、なければ "default"）ごとの登録内容を置き換える。
+
+        取り込んだショップの既存行は同じトランザクションで削除してから入れ直す。
+        Shop 列が空欄の行はどのショップか分からないため取り込まない。
+        """
+        seen_date = seen_date or datetime.today().strftime("%Y-%m-%d")
+        shops = shopee_df["Shop"] if "Shop" in shopee_df.columns else pd.Series("default", index=shopee_df.index)
+        shops = shops.fillna("").astype(str).str.strip()
+        rows = []
+        uploaded = []
+        for shop, frame in shopee_df[shops != ""].groupby(shops[shops != ""], sort=False):
+            uploaded.append((shop,))
+            skus, gtins, barcodes, gtin14 = _shopee_keys(frame)
+            for kind, keys in (("sku", skus), ("gtin", gtins), ("barcode", barcodes), ("gtin14", gtin14)):
+                rows.extend((kind, key, shop, seen_date) for key in keys.unique())
+        # 主キー順に挿入すると B-tree への追記が局所的になり、大きなカタログでも速い
+        rows.sort()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM shopee_catalog WHERE shop = ?", uploaded)
+                conn.executemany("INSERT INTO shopee_catalog VALUES (?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+        return len(rows)
+
+    def lookup_sets(self, df: pd.DataFrame) -> tuple[set, set, set, set]:
+        """在庫明細のキーのうちカタログにあるものを、build_shopee_sets と同じ形の集合で返す。"""
+        probes = []
+        if "PICKING KEY1" in df.columns:
+            _, pk1 = _factorize_keys(df["PICKING KEY1"])
+            probes.extend(("sku", key) for key in pk1[pk1 != ""])
+        if "Product Code" in df.columns:
+            _, pcode = _factorize_keys(df["Product Code"])
+            pcode = pcode[pcode != ""]
+            probes.extend(("gtin", key) for key in pcode)
+            probes.extend(("barcode", key) for key in set(pcode) | set(pcode.str.lstrip("0")))
+            probes.extend(("gtin14", key) for key in canonical_gtin_column(pcode)["gtin"].dropna().unique())
+        sets = {"sku": set(), "gtin": set(), "barcode": set(), "gtin14": set()}
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TEMP TABLE probe (kind TEXT, key TEXT, PRIMARY KEY (kind, key)) WITHOUT ROWID")
+            conn.executemany("INSERT OR IGNORE INTO probe VALUES (?, ?)", probes)
+            # 在庫側のキーを外側にして、カタログは主キーで1件ずつ引く
+            for kind, key in conn.execute(
+                "SELECT kind, key FROM probe p WHERE EXISTS ("
+                "SELECT 1 FROM shopee_catalog c WHERE c.kind = p.kind AND c.key = p.key)"
+            ):
+                sets[kind].add(key)
+        finally:
+            conn.close()
+        return sets["sku"], sets["gtin"], sets["barcode"], sets["gtin14"]
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        try:
+            entries, shops, last_seen = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT shop), MAX(last_seen) FROM shopee_catalog"
+            ).fetchone()
+        finally:
+            conn.close()
+        return {"entries": entries, "shops": shops, "last_seen": last_seen}
+
 
-    df["Arrival Date"] = pd.to_datetime(df["Arrival Date"], errors="coerce")
-    for col in ["Total Piece Qty", "Case Qty", "Total Weight", "Total Volume"]:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+def match_shopee(
+    df: pd.DataFrame, sku_set: set, gtin_set: set, barcode_set: set, gtin14_set: set = frozenset(),
+) -> pd.DataFrame:
+    """is_on_shopee と同じ4段階判定を列単位で行い、Shopee掲載 と match_reason を返す。
+
+    GTIN-14 の判定は Product Code のユニーク値を正規化したキーを集合で引くだけなので、
+    1件あたりの費用はカタログの件数によらない。
+    """
+    n_rows = len(df)
+    hit_sku = np.zeros(n_rows, dtype=bool)
+    hit_gtin = np.zeros(n_rows, dtype=bool)
+    hit_barcode = np.zeros(n_rows, dtype=bool)
+    hit_gtin14 = np.zeros(n_rows, dtype=bool)
+
+    if "PICKING KEY1" in df.columns:
+        codes, pk1 = _factorize_keys(df["PICKING KEY1"])
+        hit_sku = ((pk1 != "") & pk1.isin(sku_set)).to_numpy()[codes]
+
+    if "Product Code" in df.columns:
+        codes, pcode = _factorize_keys(df["Product Code"])
+        has_code = pcode != ""
+        hit_gtin = (has_code & pcode.isin(gtin_set)).to_numpy()[codes]
+        hit_barcode = (
+            has_code & (pcode.isin(barcode_set) | pcode.str.lstrip("0").isin(barcode_set))
+        ).to_numpy()[codes]
+        if gtin14_set:
+            hit_gtin14 = canonical_gtin_column(pcode)["gtin"].isin(gtin14_set).to_numpy()[codes]
+
+    reason = np.select(
+        [hit_sku, hit_gtin, hit_barcode, hit_gtin14], SHOPEE_MATCH_REASONS, default="",
+    )
+    return pd.DataFrame(
+        {
+            "Shopee掲載": hit_sku | hit_gtin | hit_barcode | hit_gtin14,
+            "match_reason": reason.astype(object),
+        },
+        index=df.index,
+    )
 
-    grouped = df.groupby("Product Code", as_index=False).agg(
+
+# ---------------------------------------------------------------------------
+# Product Code 集約
+# ---------------------------------------------------------------------------
+def _expiry_list_by_code(codes: np.ndarray, expiry: pd.Series, n_groups: int) -> np.ndarray:
+    """(コード, 賞味期限) の重複を除いてから、グループごとに日付文字列を1回だけ結合する。"""
+    has_expiry = expiry.notna().to_numpy()
+    pairs = pd.DataFrame({"code": codes[has_expiry], "expiry": expiry.to_numpy()[has_expiry]})
+    pairs = pairs.drop_duplicates().sort_values(["code", "expiry"])
+    expiry_list = np.full(n_groups, "", dtype=object)
+    if pairs.empty:
+        return expiry_list
+
+    # 日付の書式化はユニークな日付に対してのみ行う
+    date_codes, dates = pd.factorize(pairs["expiry"])
+    labels = dates.strftime("%Y-%m-%d").to_numpy(dtype=object)[date_codes].tolist()
+    # pairs はコード順に並んでいるので、コードの切れ目ごとにスライスして結合する
+    pair_codes = pairs["code"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, pair_codes[1:] != pair_codes[:-1]])
+    ends = np.r_[starts[1:], len(pair_codes)]
+    expiry_list[pair_codes[starts]] = [", ".join(labels[i:j]) for i, j in zip(starts, ends)]
+    return expiry_list
+
+
+def aggregate_by_product(df: pd.DataFrame, expiry_list: bool = True) -> pd.DataFrame:
+    """Product Code 単位の集計。キーは1回だけ factorize し、組み込み集計のみで処理する。
+
+    expiry_list=False なら期限一覧（文字列の結合）を作らない（部分集計用）。
+    """
+    codes, product_codes = pd.factorize(df["Product Code"], sort=True)
+    # groupby(dropna=True) と同様に Product Code が欠損した行は除外する
+    keep = codes >= 0
+    if not keep.all():
+        df = df[keep]
+        codes = codes[keep]
+
+    grouped = df.groupby(codes, sort=True).agg(
         商品名=("Product Name", "first"),
         入庫回数=("Arrival Date", "count"),
         最古入庫日=("Arrival Date", "min"),
@@ -446,21 +1352,438 @@ def run_analysis(
         合計重量=("Total Weight", "sum"),
         合計体積=("Total Volume", "sum"),
         Shopee掲載=("Shopee掲載", "any"),
+        一致ルール=("match_reason", "min"),
         最早期限日=("賞味期限", "min"),
-        期限一覧=("賞味期限", lambda x: ", ".join(sorted(set(
-            d.strftime("%Y-%m-%d") for d in x.dropna()
-        )))),
-    )
+    ).reset_index(drop=True)
+    # 省メモリモードで縮小した数値型でも、合計は int64 / float64 にそろえる
+    for col in ["合計数量", "合計ケース数", "合計重量", "合計体積"]:
+        if pd.api.types.is_integer_dtype(grouped[col]):
+            grouped[col] = grouped[col].astype(np.int64)
+        elif pd.api.types.is_float_dtype(grouped[col]):
+            grouped[col] = grouped[col].astype(np.float64)
+    grouped.insert(0, "Product Code", product_codes)
+    if expiry_list:
+        grouped["期限一覧"] = _expiry_list_by_code(codes, df["賞味期限"], len(product_codes))
+    return grouped
+
+
+# ---------------------------------------------------------------------------
+# メイン分析処理
+# ---------------------------------------------------------------------------
+def compact_frame(df: pd.DataFrame, categorical: tuple = ()) -> pd.DataFrame:
+    """値を変えずにメモリを減らす。
+
+    文字列だけの object 列は Arrow 文字列に、categorical の列はカテゴリにし、
+    数値列は値が変わらない範囲で小さい型にする。
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        values = df[col]
+        if col in categorical:
+            df[col] = values.astype("category")
+        elif values.dtype == object:
+            if pd.api.types.infer_dtype(values, skipna=True) == "string":
+                df[col] = values.astype("str")
+        elif pd.api.types.is_bool_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            df[col] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values) and values.dtype != np.float32:
+            narrow = values.astype(np.float32)
+            if ((narrow.astype(values.dtype) == values) | values.isna()).all():
+                df[col] = narrow
+    return df
+
+
+def _record_memory(report: list | None, stage: str, df: pd.DataFrame):
+    if report is not None:
+        report.append({
+            "段階": stage,
+            "行数": len(df),
+            "列数": len(df.columns),
+            "メモリ(MB)": round(float(df.memory_usage(deep=True).sum()) / 1024 / 1024, 1),
+        })
+
+
+def prepare_lots(
+    inv_df: pd.DataFrame,
+    shopee_df: pd.DataFrame | None,
+    include_blank_key7: bool = False,
+    catalog: ShopeeCatalog | None = None,
+    lean: bool = False,
+    memory_report: list | None = None,
+) -> pd.DataFrame:
+    """EC 対象の明細を抽出し、賞味期限・Shopee掲載・数値列を整えた明細を返す。
+
+    catalog を渡すと、アップロードされた Shopee 商品リストではなく保存済みカタログで判定する。
+    lean=True なら抽出した明細を compact_frame で圧縮する。memory_report には段階ごとの
+    memory_usage(deep=True) を追記する。
+    """
+    _record_memory(memory_report, "入力", inv_df)
+    with perf_stage("EC 対象の抽出", rows=len(inv_df)):
+        # KEY7 の正規化はユニーク値に対してのみ行う
+        key7_codes, key7_values = pd.factorize(inv_df["PICKING KEY7"], use_na_sentinel=False)
+        mask = is_ec_key7(key7_values, include_blank_key7)[key7_codes]
+        # 分析に使わない列はコピーする前に落とす
+        df = inv_df.loc[mask, [c for c in inv_df.columns if _is_inventory_column(c)]]
+        if lean:
+            df = compact_frame(df, categorical=("PICKING KEY7", "Sub Inventory"))
+    if df.empty:
+        return pd.DataFrame()
+
+    with perf_stage("賞味期限の解析", rows=len(df)):
+        df["賞味期限"] = parse_expiry_column(df["Sub Inventory"])
+
+    with perf_stage("Shopee 掲載判定", rows=len(df)):
+        if catalog is not None or (shopee_df is not None and not shopee_df.empty):
+            if catalog is not None:
+                sku_set, gtin_set, barcode_set, gtin14_set = catalog.lookup_sets(df)
+            else:
+                sku_set, gtin_set, barcode_set, gtin14_set = build_shopee_sets(shopee_df)
+            matched = match_shopee(df, sku_set, gtin_set, barcode_set, gtin14_set)
+            df["Shopee掲載"] = matched["Shopee掲載"]
+            df["match_reason"] = pd.Categorical(matched["match_reason"], dtype=MATCH_REASON_DTYPE)
+        else:
+            df["Shopee掲載"] = False
+            df["match_reason"] = pd.Categorical([""] * len(df), dtype=MATCH_REASON_DTYPE)
+
+    with perf_stage("日付・数値の変換", rows=len(df)):
+        df["Arrival Date"] = pd.to_datetime(df["Arrival Date"], errors="coerce")
+        for col in ["Total Piece Qty", "Case Qty", "Total Weight", "Total Volume"]:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+        if lean:
+            df = compact_frame(df)
+    _record_memory(memory_report, "明細", df)
+    return df
+
+
+NO_TARGET_MESSAGE = "対象レコードが見つかりません。PICKING KEY7 の値を確認してください。"
+
 
+def finalize_aggregates(grouped: pd.DataFrame) -> pd.DataFrame:
+    """Product Code 単位の集計に滞留日数・Aging・期限ステータス・B2B候補を付けて並べ替える。"""
+    today = pd.Timestamp(datetime.today().date())
+    grouped = grouped.copy()
     grouped["滞留日数"] = (today - grouped["最古入庫日"]).dt.days
     grouped["滞留日数"] = grouped["滞留日数"].fillna(0).astype(int)
-    grouped["Agingカテゴリ"] = grouped["滞留日数"].apply(categorize_aging)
-    grouped["期限ステータス"] = grouped["最早期限日"].apply(lambda d: expiry_status(d, today))
+    grouped["Agingカテゴリ"] = categorize_aging_column(grouped["滞留日数"])
+    grouped["期限ステータス"] = expiry_status_column(grouped["最早期限日"], today)
     grouped["B2B候補"] = (grouped["滞留日数"] >= 90) | (grouped["合計数量"] >= 10)
     grouped = grouped.sort_values("滞留日数", ascending=False).reset_index(drop=True)
     return grouped
 
 
+def run_analysis(
+    inv_df: pd.DataFrame,
+    shopee_df: pd.DataFrame | None,
+    include_blank_key7: bool = False,
+    catalog: ShopeeCatalog | None = None,
+    lean: bool = False,
+    memory_report: list | None = None,
+) -> pd.DataFrame:
+    df = prepare_lots(inv_df, shopee_df, include_blank_key7, catalog, lean, memory_report)
+    if df.empty:
+        st.error(NO_TARGET_MESSAGE)
+        return pd.DataFrame()
+    with perf_stage("Product Code 集約", rows=len(df)):
+        grouped = aggregate_by_product(df)
+    _record_memory(memory_report, "集計", grouped)
+    with perf_stage("Aging・期限ステータス", rows=len(grouped)):
+        result = finalize_aggregates(grouped)
+    _record_memory(memory_report, "結果", result)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# 複数ファイルの集計（map-reduce）
+# ---------------------------------------------------------------------------
+# 部分集計どうしをまとめるときの集計方法（aggregate_by_product の各列に対応）
+PARTIAL_MERGE_AGGREGATIONS = {
+    "商品名": "first",
+    "入庫回数": "sum",
+    "最古入庫日": "min",
+    "最新入庫日": "max",
+    "合計数量": "sum",
+    "合計ケース数": "sum",
+    "合計重量": "sum",
+    "合計体積": "sum",
+    "Shopee掲載": "any",
+    "一致ルール": "min",
+    "最早期限日": "min",
+}
+
+
+def _map_inventory_file(
+    name: str,
+    data: bytes,
+    shopee_df: pd.DataFrame | None,
+    include_blank_key7: bool,
+    catalog_path: str | None,
+    stream: bool,
+    lean: bool,
+    memory: bool = False,
+) -> dict:
+    """在庫ファイル1つを読み込み、EC 対象の明細を Product Code 単位の部分集計にする（ワーカーで実行）。
+
+    期限一覧は結合済みの文字列ではなく (Product Code, 賞味期限) のユニークな組で返し、まとめる側で結合する。
+    計測した段階は records で、memory=True ならメモリ使用量の段階は memory で返す。
+    """
+    memory_report = [] if memory else None
+    timer = StageTimer(trace_memory=False)
+    token = _active_timer.set(timer)
+    try:
+        with perf_stage(f"在庫ファイル: {name}") as record:
+            with perf_stage("ファイル読込"):
+                try:
+                    if stream:
+                        inv_df = load_inventory_streaming(io.BytesIO(data), include_blank_key7)
+                    else:
+                        inv_df = load_inventory(io.BytesIO(data))
+                except ValueError as e:
+                    raise ValueError(f"「{name}」: {e}") from None
+            record["rows"] = len(inv_df)
+            catalog = ShopeeCatalog(catalog_path) if catalog_path else None
+            df = prepare_lots(inv_df, shopee_df, include_blank_key7, catalog, lean, memory_report)
+            del inv_df
+            with perf_stage("部分集計", rows=len(df)):
+                if df.empty:
+                    partial, pairs = pd.DataFrame(), pd.DataFrame()
+                else:
+                    partial = aggregate_by_product(df, expiry_list=False)
+                    # aggregate_by_product と同じく Product Code が欠損した明細は期限一覧にも含めない
+                    has_pair = df["Product Code"].notna() & df["賞味期限"].notna()
+                    pairs = df.loc[has_pair, ["Product Code", "賞味期限"]].drop_duplicates()
+            _record_memory(memory_report, "部分集計", partial)
+    finally:
+        _active_timer.reset(token)
+    return {
+        "name": name, "partial": partial, "pairs": pairs, "records": timer.records, "memory": memory_report or [],
+    }
+
+
+def _unique_names(names: list[str]) -> list[str]:
+    """同じ名前が重なったら2つ目以降に「 (2)」「 (3)」… を付け、倉庫の表示名を一意にする。"""
+    seen = set(names)
+    counts = {}
+    unique = []
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] == 1:
+            unique.append(name)
+            continue
+        n = counts[name]
+        while f"{name} ({n})" in seen:
+            n += 1
+        label = f"{name} ({n})"
+        seen.add(label)
+        counts[name] = n
+        unique.append(label)
+    return unique
+
+
+def _quantity_text(qty) -> str:
+    return f"{int(qty):,}" if float(qty).is_integer() else f"{qty:,}"
+
+
+def merge_partial_aggregates(partials: list[dict], warehouse_breakdown: bool = False) -> pd.DataFrame:
+    """ファイルごとの部分集計をまとめ、aggregate_by_product と同じ形の集計にする。
+
+    partials はファイルの順に並べる（商品名の first が全明細を連結したときと同じになる）。
+    warehouse_breakdown=True なら「倉庫別数量」（ファイル名: 数量）の列を加える。
+    """
+    frames = [p["partial"].assign(倉庫=p["name"]) for p in partials if not p["partial"].empty]
+    if not frames:
+        return pd.DataFrame()
+    parts = pd.concat(frames, ignore_index=True)
+    codes, product_codes = pd.factorize(parts["Product Code"], sort=True)
+    grouped = parts.groupby(codes, sort=True).agg(
+        **{col: (col, how) for col, how in PARTIAL_MERGE_AGGREGATIONS.items()}
+    ).reset_index(drop=True)
+    grouped.insert(0, "Product Code", product_codes)
+
+    pair_frames = [p["pairs"] for p in partials if not p["pairs"].empty]
+    pairs = pd.concat(pair_frames, ignore_index=True) if pair_frames else pd.DataFrame()
+    if pairs.empty:
+        grouped["期限一覧"] = ""
+    else:
+        pair_codes = product_codes.get_indexer(pairs["Product Code"])
+        # 集計にないコード（-1）のまま渡すと末尾の商品の期限一覧に混ざるため除く
+        known = pair_codes >= 0
+        grouped["期限一覧"] = _expiry_list_by_code(
+            pair_codes[known], pairs["賞味期限"][known], len(product_codes),
+        )
+
+    if warehouse_breakdown:
+        # parts はファイル順に並んでいるので、コード順に安定ソートすればファイル順が保たれる
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        labels = [
+            f"{name}: {_quantity_text(qty)}"
+            for name, qty in zip(parts["倉庫"].to_numpy()[order], parts["合計数量"].to_numpy()[order])
+        ]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ends = np.r_[starts[1:], len(sorted_codes)]
+        grouped.insert(
+            grouped.columns.get_loc("合計数量") + 1,
+            "倉庫別数量",
+            [" / ".join(labels[i:j]) for i, j in zip(starts, ends)],
+        )
+    return grouped
+
+
+def _importable(func):
+    """子プロセスから import できる関数を返す。
+
+    Streamlit は app.py を __main__ として実行するため、そのままでは spawn / forkserver の
+    ワーカーに関数を渡せない。同じファイルをモジュールとして import し直した関数を使う。
+    """
+    if func.__module__ != "__main__":
+        return func
+    module = importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
+    return getattr(module, func.__name__)
+
+
+@st.cache_resource
+def _inventory_pool() -> ProcessPoolExecutor:
+    """在庫ファイルの map を実行するプロセスプール（全セッション共有、ワーカーは使い回す）。
+
+    Streamlit のサーバーはマルチスレッドのため fork は使わず、forkserver（なければ spawn）で起動する。
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=INVENTORY_WORKERS, mp_context=context)
+
+
+def run_analysis_files(
+    inv_files: list,
+    shopee_df: pd.DataFrame | None,
+    include_blank_key7: bool = False,
+    catalog: ShopeeCatalog | None = None,
+    stream: bool = False,
+    lean: bool = False,
+    warehouse_breakdown: bool = False,
+    workers: int = INVENTORY_WORKERS,
+    memory_report: list | None = None,
+) -> pd.DataFrame:
+    """複数の在庫ファイル（倉庫ごとのエクスポート）を map-reduce で分析する。
+
+    各ファイルの読込・抽出・部分集計（map）はワーカープロセスで並列に行い、まとめ（reduce）と
+    Aging の判定はこのプロセスで行う。workers=1 なら同じ処理をこのプロセスで順に行う。
+    memory_report には各ファイルの段階（「段階（ファイル名）」）と、まとめた後の段階を追記する。
+    """
+    names = _unique_names([
+        os.path.splitext(getattr(f, "name", None) or os.path.basename(str(f)))[0] for f in inv_files
+    ])
+    tasks = [(name, _file_bytes(f)) for name, f in zip(names, inv_files)]
+    options = (
+        shopee_df, include_blank_key7, catalog.path if catalog is not None else None, stream, lean,
+        memory_report is not None,
+    )
+    if min(workers, len(tasks)) <= 1:
+        partials = [_map_inventory_file(name, data, *options) for name, data in tasks]
+    else:
+        pool = _inventory_pool()
+        mapper = _importable(_map_inventory_file)
+        futures = [pool.submit(mapper, name, data, *options) for name, data in tasks]
+        try:
+            partials = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # 壊れたプールは捨て、次の実行で作り直す
+            _inventory_pool.clear()
+            raise ValueError("在庫リストの集計ワーカーが異常終了しました。もう一度実行してください。")
+        finally:
+            for future in futures:
+                future.cancel()
+
+    timer = _active_timer.get()
+    if timer is not None:
+        for partial in partials:
+            timer.merge(partial["records"])
+    if memory_report is not None:
+        for partial in partials:
+            memory_report.extend({**r, "段階": f"{r['段階']}（{partial['name']}）"} for r in partial["memory"])
+    with perf_stage("Product Code 集約（マージ）", rows=sum(len(p["partial"]) for p in partials)):
+        grouped = merge_partial_aggregates(partials, warehouse_breakdown)
+    if grouped.empty:
+        st.error(NO_TARGET_MESSAGE)
+        return pd.DataFrame()
+    _record_memory(memory_report, "集計", grouped)
+    with perf_stage("Aging・期限ステータス", rows=len(grouped)):
+        result = finalize_aggregates(grouped)
+    _record_memory(memory_report, "結果", result)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# サマリキューブ
+# ---------------------------------------------------------------------------
+SUMMARY_CUBE_KEYS = ["Agingカテゴリ", "期限ステータス", "Shopee掲載", "B2B候補"]
+
+
+class SummaryCube:
+    """Agingカテゴリ × 期限ステータス × Shopee掲載 × B2B候補 ごとの SKU数・合計数量（最大 96 行）。
+
+    分析結果ごとに1回だけ作り、KPI・Aging カテゴリ別集計・Excel のサマリ・Slack のメッセージ・
+    明細の絞り込み後の件数は、結果を走査し直さずにこの表から求める。
+    """
+
+    def __init__(self, result_df: pd.DataFrame, fingerprint: str | None = None):
+        self.fingerprint = fingerprint
+        self.cells = result_df.groupby(SUMMARY_CUBE_KEYS, observed=True, dropna=False).agg(
+            SKU数=("Product Code", "size"),
+            合計数量=("合計数量", "sum"),
+        ).reset_index()
+        # 問い合わせは小さな配列の演算だけで済むよう、列を numpy で持っておく
+        self.aging_codes, self.aging_labels = pd.factorize(self.cells["Agingカテゴリ"], sort=True)
+        self.counts = self.cells["SKU数"].to_numpy()
+        self.qty = self.cells["合計数量"].to_numpy()
+        self.shopee = self.cells["Shopee掲載"].to_numpy(dtype=bool)
+        self.b2b = self.cells["B2B候補"].to_numpy(dtype=bool)
+        self.expiry_warn = self.cells["期限ステータス"].isin(["期限切れ", "3ヶ月以内"]).to_numpy(dtype=bool)
+
+    def kpis(self) -> dict:
+        """KPI カードの4指標（全SKU数・Shopee掲載・期限注意・B2B候補）。"""
+        return {
+            "total_sku": int(self.counts.sum()),
+            "shopee_count": int(self.counts[self.shopee].sum()),
+            "expiry_warn": int(self.counts[self.expiry_warn].sum()),
+            "b2b_count": int(self.counts[self.b2b].sum()),
+        }
+
+    def aging_summary(self) -> pd.DataFrame:
+        """Agingカテゴリ別の SKU数・Shopee掲載数・合計数量・期限注意・構成比。"""
+        n = len(self.aging_labels)
+
+        def by_aging(values: np.ndarray) -> np.ndarray:
+            sums = np.zeros(n, dtype=values.dtype)
+            np.add.at(sums, self.aging_codes, values)
+            return sums
+
+        summary = pd.DataFrame({
+            "Agingカテゴリ": self.aging_labels,
+            "SKU数": by_aging(self.counts),
+            "Shopee掲載数": by_aging(np.where(self.shopee, self.counts, 0)),
+            "合計数量": by_aging(self.qty),
+            "期限注意": by_aging(np.where(self.expiry_warn, self.counts, 0)),
+        })
+        summary["構成比"] = (summary["SKU数"] / summary["SKU数"].sum() * 100).round(1)
+        return summary
+
+    def totals(self, aging_filter: list, shopee_filter: str = "すべて", b2b_filter: str = "すべて") -> dict:
+        """明細のフィルタ（DetailView.filter と同じ条件）に当てはまる SKU数・合計数量。"""
+        mask = np.isin(self.aging_codes, self.aging_labels.get_indexer(list(aging_filter)))
+        if shopee_filter == "掲載あり":
+            mask = mask & self.shopee
+        elif shopee_filter == "未掲載":
+            mask = mask & ~self.shopee
+        if b2b_filter == "候補のみ":
+            mask = mask & self.b2b
+        elif b2b_filter == "候補外":
+            mask = mask & ~self.b2b
+        return {"sku": int(self.counts[mask].sum()), "qty": self.qty[mask].sum()}
+
+
 # ---------------------------------------------------------------------------
 # Excel 出力
 # ---------------------------------------------------------------------------
@@ -473,46 +1796,79 @@ def _apply_header_style(ws, max_col: int):
         cell.border = THIN_BORDER
 
 
-def _auto_width(ws):
-    from openpyxl.cell.cell import MergedCell
-    for col in ws.columns:
-        max_len = 0
-        col_letter = None
-        for cell in col:
-            if isinstance(cell, MergedCell):
-                continue
-            if col_letter is None:
-                col_letter = cell.column_letter
-            try:
-                val = str(cell.value) if cell.value is not None else ""
-                length = sum(2 if ord(c) > 127 else 1 for c in val)
-                max_len = max(max_len, length)
-            except Exception:
-                pass
-        if col_letter:
-            ws.column_dimensions[col_letter].width = min(max_len + 3, 50)
+def _display_width(text: str) -> int:
+    """全角文字を2、半角文字を1として表示幅を数える。"""
+    return sum(2 if ord(c) > 127 else 1 for c in text)
+
+
+def _cell_text(col: pd.Series) -> pd.Series:
+    """セルに書き込まれる値を str() した文字列を返す（欠損は空文字）。"""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        text = col.dt.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        text = col.astype(str)
+    return text.where(col.notna(), "")
+
+
+def _column_widths(
+    df: pd.DataFrame,
+    include_header: bool = True,
+    sample_rows: int | None = EXCEL_WIDTH_SAMPLE_ROWS,
+    quantile: float | None = None,
+) -> list[float]:
+    """DataFrame から Excel の列幅（表示幅 + 3、上限 50）を計算する。
+
+    sample_rows より行数が多い場合は無作為抽出した行で見積もる。quantile を指定すると
+    最大値の代わりにその分位点を使い、一部の極端に長い値に幅が引きずられないようにする。
+    """
+    if sample_rows is not None and len(df) > sample_rows:
+        df = df.sample(n=sample_rows, random_state=0)
+    widths = []
+    for col in df.columns:
+        # 表示幅はユニークな文字列ごとに1回だけ計算する（全角は2、半角は1）
+        codes, texts = pd.factorize(_cell_text(df[col]))
+        texts = pd.Series(texts, dtype=object)
+        unique_lengths = (texts.str.len() + texts.str.count(r"[^\x00-\x7f]")).to_numpy()
+        lengths = unique_lengths[codes]
+        if len(lengths) == 0:
+            max_len = 0
+        elif quantile is not None:
+            max_len = int(np.ceil(np.quantile(lengths, quantile)))
+        else:
+            max_len = int(lengths.max())
+        if include_header:
+            max_len = max(max_len, _display_width(str(col)))
+        widths.append(min(max_len + 3, 50))
+    return widths
+
+
+def _set_column_widths(ws, widths: list[float]):
+    for c_idx, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(c_idx)].width = width
 
 
 def _color_detail_rows(ws, header_map: dict, row_count: int):
     shopee_col = header_map.get("Shopee掲載")
     expiry_col = header_map.get("期限ステータス")
     aging_col = header_map.get("滞留日数")
+    # ws.max_column は全セルを走査するので、行ループの外で1回だけ求める
+    max_col = ws.max_column
 
     for row_idx in range(2, row_count + 2):
         if shopee_col:
             val = ws.cell(row=row_idx, column=shopee_col).value
             if val is True or str(val).strip() in ("True", "●", "1"):
-                for c in range(1, ws.max_column + 1):
+                for c in range(1, max_col + 1):
                     ws.cell(row=row_idx, column=c).fill = FILL_SHOPEE
 
         if expiry_col:
             exp_val = str(ws.cell(row=row_idx, column=expiry_col).value or "")
             if exp_val == "期限切れ":
-                for c in range(1, ws.max_column + 1):
+                for c in range(1, max_col + 1):
                     ws.cell(row=row_idx, column=c).fill = FILL_EXPIRED
                     ws.cell(row=row_idx, column=c).font = FONT_EXPIRED
             elif exp_val == "3ヶ月以内":
-                for c in range(1, ws.max_column + 1):
+                for c in range(1, max_col + 1):
                     ws.cell(row=row_idx, column=c).fill = FILL_NEAR_EXPIRY
 
         if aging_col and expiry_col:
@@ -522,16 +1878,51 @@ def _color_detail_rows(ws, header_map: dict, row_count: int):
                 if isinstance(days_val, (int, float)):
                     days_int = int(days_val)
                     if days_int <= 60:
-                        for c in range(1, ws.max_column + 1):
+                        for c in range(1, max_col + 1):
                             ws.cell(row=row_idx, column=c).fill = FILL_GREEN
                     elif days_int <= 180:
-                        for c in range(1, ws.max_column + 1):
+                        for c in range(1, max_col + 1):
                             ws.cell(row=row_idx, column=c).fill = FILL_YELLOW
                     elif days_int > 180:
-                        for c in range(1, ws.max_column + 1):
+                        for c in range(1, max_col + 1):
                             ws.cell(row=row_idx, column=c).fill = FILL_PINK
 
 
+def _add_row_color_rules(ws, columns: list, row_count: int):
+    """_color_detail_rows と同じ色分けを、データ範囲全体への条件付き書式（数式ルール）で表す。
+
+    ルールは優先度の高い順に追加し、stopIfTrue で最初に一致した色だけを適用する。
+    """
+    if row_count == 0:
+        return
+    letters = {col: get_column_letter(i) for i, col in enumerate(columns, start=1)}
+    data_range = f"A2:{get_column_letter(len(columns))}{row_count + 1}"
+
+    rules = []
+    if "期限ステータス" in letters:
+        exp = f"${letters['期限ステータス']}2"
+        rules += [(f'{exp}="期限切れ"', "expired"), (f'{exp}="3ヶ月以内"', "near")]
+        if "滞留日数" in letters:
+            days = f"${letters['滞留日数']}2"
+            rules += [
+                (f"AND(ISNUMBER({days}),TRUNC({days})<=60)", "green"),
+                (f"AND(ISNUMBER({days}),TRUNC({days})<=180)", "yellow"),
+                (f"ISNUMBER({days})", "pink"),
+            ]
+    if "Shopee掲載" in letters:
+        shopee = f"${letters['Shopee掲載']}2"
+        rules.append((
+            f'OR({shopee}=TRUE,TRIM({shopee})="●",TRIM({shopee})="True",TRIM({shopee})="1")',
+            "shopee",
+        ))
+
+    for formula, kind in rules:
+        fill, font = ROW_FILL_STYLES[kind]
+        ws.conditional_formatting.add(
+            data_range, FormulaRule(formula=[formula], fill=fill, font=font, stopIfTrue=True),
+        )
+
+
 def _write_df_to_sheet(ws, df: pd.DataFrame, freeze: bool = True):
     for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), start=1):
         for c_idx, val in enumerate(row, start=1):
@@ -545,151 +1936,468 @@ def _write_df_to_sheet(ws, df: pd.DataFrame, freeze: bool = True):
                 cell.value = val
             cell.border = THIN_BORDER
     _apply_header_style(ws, len(df.columns))
-    _auto_width(ws)
+    _set_column_widths(ws, _column_widths(df))
     if freeze:
         ws.freeze_panes = "A2"
     if len(df) > 0:
         ws.auto_filter.ref = ws.dimensions
 
 
-def generate_excel(result_df: pd.DataFrame) -> bytes:
-    wb = Workbook()
+def _summary_sheet_rows(result_df: pd.DataFrame, cube: SummaryCube | None = None) -> list[list]:
+    """サマリシートの行データ（タイトル・KPI・Agingカテゴリ別集計・凡例）。"""
     today_str = datetime.today().strftime("%Y-%m-%d")
-
-    # --- シート1: サマリ ---
-    ws1 = wb.active
-    ws1.title = "サマリ"
-    aging_summary = result_df.groupby("Agingカテゴリ", sort=False).agg(
-        SKU数=("Product Code", "count"),
-        Shopee掲載数=("Shopee掲載", "sum"),
-        合計数量=("合計数量", "sum"),
-        期限注意=("期限ステータス", lambda x: ((x == "期限切れ") | (x == "3ヶ月以内")).sum()),
-    ).reset_index()
-    aging_summary["構成比"] = (aging_summary["SKU数"] / aging_summary["SKU数"].sum() * 100).round(1)
-    cat_order = [label for _, _, label in AGING_BINS]
-    aging_summary["_sort"] = aging_summary["Agingカテゴリ"].apply(
-        lambda x: cat_order.index(x) if x in cat_order else 999
-    )
-    aging_summary = aging_summary.sort_values("_sort").drop(columns="_sort").reset_index(drop=True)
-
-    ws1.append([f"在庫Aging分析サマリ（{today_str}）"])
-    ws1.merge_cells(start_row=1, start_column=1, end_row=1, end_column=6)
-    ws1.cell(1, 1).font = Font(bold=True, size=14)
-    ws1.append([])
-
-    total_sku = len(result_df)
-    shopee_count = int(result_df["Shopee掲載"].sum())
-    expiry_warn = int(((result_df["期限ステータス"] == "期限切れ") | (result_df["期限ステータス"] == "3ヶ月以内")).sum())
-    b2b_count = int(result_df["B2B候補"].sum())
-    ws1.append(["全SKU数", total_sku, "", "Shopee掲載数", shopee_count])
-    ws1.append(["期限注意数", expiry_warn, "", "B2B候補数", b2b_count])
-    ws1.append([])
-
-    ws1.append(["【Agingカテゴリ別集計】"])
-    ws1.cell(ws1.max_row, 1).font = Font(bold=True, size=11)
-    start_row = ws1.max_row + 1
-    headers = ["Agingカテゴリ", "SKU数", "Shopee掲載数", "合計数量", "期限注意", "構成比(%)"]
-    ws1.append(headers)
-    for c_idx in range(1, len(headers) + 1):
-        cell = ws1.cell(start_row, c_idx)
-        cell.fill = HEADER_FILL
-        cell.font = HEADER_FONT
-        cell.border = THIN_BORDER
-
+    cube = cube or SummaryCube(result_df)
+    aging_summary = cube.aging_summary()
+    kpis = cube.kpis()
+
+    rows = [
+        [f"在庫Aging分析サマリ（{today_str}）"],
+        [],
+        ["全SKU数", kpis["total_sku"], "", "Shopee掲載数", kpis["shopee_count"]],
+        ["期限注意数", kpis["expiry_warn"], "", "B2B候補数", kpis["b2b_count"]],
+        [],
+        ["【Agingカテゴリ別集計】"],
+        SUMMARY_HEADERS,
+    ]
     for _, arow in aging_summary.iterrows():
-        ws1.append([
+        rows.append([
             arow["Agingカテゴリ"], int(arow["SKU数"]), int(arow["Shopee掲載数"]),
             arow["合計数量"], int(arow["期限注意"]), arow["構成比"],
         ])
-
-    ws1.append([])
-    ws1.append(["【凡例】"])
-    ws1.append(["水色行", "Shopee掲載済み"])
-    ws1.append(["赤行", "期限切れ"])
-    ws1.append(["オレンジ行", "期限3ヶ月以内"])
-    ws1.append(["緑行", "Aging 0-60日"])
-    ws1.append(["黄行", "Aging 61-180日"])
-    ws1.append(["ピンク行", "Aging 181日超"])
-    _auto_width(ws1)
-
-    # --- シート2: 商品別Aging明細 ---
-    ws2 = wb.create_sheet("商品別Aging明細")
-    display_df = result_df.copy()
-    display_df["Shopee掲載"] = display_df["Shopee掲載"].map({True: "●", False: ""})
-    display_df["B2B候補"] = display_df["B2B候補"].map({True: "●", False: ""})
-    _write_df_to_sheet(ws2, display_df)
-    header_map = {col: i + 1 for i, col in enumerate(display_df.columns)}
-    _color_detail_rows(ws2, {
-        "Shopee掲載": header_map.get("Shopee掲載"),
-        "期限ステータス": header_map.get("期限ステータス"),
-        "滞留日数": header_map.get("滞留日数"),
-    }, len(display_df))
-
-    # --- シート3: 期限注意リスト ---
-    ws3 = wb.create_sheet("⚠期限注意リスト")
-    expiry_df = result_df[result_df["期限ステータス"].isin(["期限切れ", "3ヶ月以内"])].copy()
-    expiry_df["Shopee掲載"] = expiry_df["Shopee掲載"].map({True: "●", False: ""})
-    expiry_df["B2B候補"] = expiry_df["B2B候補"].map({True: "●", False: ""})
-    if not expiry_df.empty:
-        _write_df_to_sheet(ws3, expiry_df)
-        hm3 = {col: i + 1 for i, col in enumerate(expiry_df.columns)}
-        _color_detail_rows(ws3, {
-            "Shopee掲載": hm3.get("Shopee掲載"),
-            "期限ステータス": hm3.get("期限ステータス"),
-            "滞留日数": hm3.get("滞留日数"),
-        }, len(expiry_df))
+    rows += [
+        [],
+        ["【凡例】"],
+        ["水色行", "Shopee掲載済み"],
+        ["赤行", "期限切れ"],
+        ["オレンジ行", "期限3ヶ月以内"],
+        ["緑行", "Aging 0-60日"],
+        ["黄行", "Aging 61-180日"],
+        ["ピンク行", "Aging 181日超"],
+    ]
+    return rows
+
+
+def _detail_sheets(result_df: pd.DataFrame) -> list[tuple[str, pd.DataFrame, str | None]]:
+    """シート2〜4の (シート名, 出力データ, 0件時のメッセージ) を返す。"""
+    expiry_mask = result_df["期限ステータス"].isin(["期限切れ", "3ヶ月以内"])
+    b2b_mask = result_df["B2B候補"] & ~result_df["Shopee掲載"]
+    sheets = [
+        ("商品別Aging明細", result_df, None),
+        ("⚠期限注意リスト", result_df[expiry_mask], "期限注意の商品はありません。"),
+        ("B2B候補_Shopee未掲載", result_df[b2b_mask], "B2B候補（Shopee未掲載）の商品はありません。"),
+    ]
+    out = []
+    for title, df, empty_message in sheets:
+        df = df.copy()
+        df["Shopee掲載"] = df["Shopee掲載"].map({True: "●", False: ""})
+        df["B2B候補"] = df["B2B候補"].map({True: "●", False: ""})
+        out.append((title, df, empty_message))
+    return out
+
+
+def _row_fill_kinds(df: pd.DataFrame) -> np.ndarray:
+    """_color_detail_rows と同じ優先順位で、各行の塗り分け種別（ROW_FILL_STYLES のキー）を返す。"""
+    kinds = np.full(len(df), "", dtype=object)
+    if "Shopee掲載" in df.columns:
+        shopee = df["Shopee掲載"].astype(str).str.strip().isin(["True", "●", "1"]).to_numpy()
+        kinds[shopee] = "shopee"
+    if "期限ステータス" in df.columns:
+        status = df["期限ステータス"].astype(object).fillna("").to_numpy()
+        kinds[status == "期限切れ"] = "expired"
+        kinds[status == "3ヶ月以内"] = "near"
+        if "滞留日数" in df.columns:
+            days = np.trunc(pd.to_numeric(df["滞留日数"], errors="coerce").to_numpy(dtype=float))
+            aging = ~np.isin(status, ["期限切れ", "3ヶ月以内"]) & ~np.isnan(days)
+            kinds[aging & (days <= 60)] = "green"
+            kinds[aging & (days > 60) & (days <= 180)] = "yellow"
+            kinds[aging & (days > 180)] = "pink"
+    return kinds
+
+
+def _excel_values(col: pd.Series) -> list:
+    """列を Excel セルに書き込める Python 値のリストに変換する（欠損は None）。"""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        values = col.dt.to_pydatetime()
     else:
-        ws3.append(["期限注意の商品はありません。"])
-
-    # --- シート4: B2B候補_Shopee未掲載 ---
-    ws4 = wb.create_sheet("B2B候補_Shopee未掲載")
-    b2b_df = result_df[(result_df["B2B候補"]) & (~result_df["Shopee掲載"])].copy()
-    b2b_df["Shopee掲載"] = b2b_df["Shopee掲載"].map({True: "●", False: ""})
-    b2b_df["B2B候補"] = b2b_df["B2B候補"].map({True: "●", False: ""})
-    if not b2b_df.empty:
-        _write_df_to_sheet(ws4, b2b_df)
-        hm4 = {col: i + 1 for i, col in enumerate(b2b_df.columns)}
-        _color_detail_rows(ws4, {
-            "Shopee掲載": hm4.get("Shopee掲載"),
-            "期限ステータス": hm4.get("期限ステータス"),
-            "滞留日数": hm4.get("滞留日数"),
-        }, len(b2b_df))
+        values = col.to_numpy(dtype=object)
+    return np.where(col.isna().to_numpy(), None, values).tolist()
+
+
+def _stream_df_to_sheet(
+    wb: Workbook, title: str, df: pd.DataFrame,
+    conditional_format: bool = False, chunk_size: int = 10_000,
+):
+    """write_only シートに DataFrame を書き出す。スタイルは行種別ごとに作成済みのセルを使い回す。"""
+    ws = wb.create_sheet(title)
+    n_cols = len(df.columns)
+    is_date = [pd.api.types.is_datetime64_any_dtype(df[c]) for c in df.columns]
+
+    # write_only では列幅・ウィンドウ枠の固定を行より先に設定する必要がある
+    _set_column_widths(ws, _column_widths(df))
+    ws.freeze_panes = "A2"
+
+    header = []
+    for col in df.columns:
+        cell = WriteOnlyCell(ws, value=col)
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+        cell.alignment = Alignment(horizontal="center", wrap_text=True)
+        cell.border = THIN_BORDER
+        header.append(cell)
+    ws.append(header)
+
+    # 行種別 × 列ごとにスタイル済みセルを1つずつ用意し、値だけ差し替えて append する
+    # （write_only の append はその場でセルを書き出すため、同じセルを再利用できる）
+    row_cells = {}
+    for kind in ["", *ROW_FILL_STYLES]:
+        fill, font = ROW_FILL_STYLES.get(kind, (None, None))
+        cells = []
+        for date_col in is_date:
+            cell = WriteOnlyCell(ws)
+            cell.border = THIN_BORDER
+            if fill is not None:
+                cell.fill = fill
+            if font is not None:
+                cell.font = font
+            if date_col:
+                cell.number_format = "YYYY-MM-DD"
+            cells.append(cell)
+        row_cells[kind] = cells
+
+    if conditional_format:
+        kinds = np.full(len(df), "", dtype=object)
+        _add_row_color_rules(ws, list(df.columns), len(df))
     else:
-        ws4.append(["B2B候補（Shopee未掲載）の商品はありません。"])
+        kinds = _row_fill_kinds(df)
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        columns = [_excel_values(chunk[c]) for c in chunk.columns]
+        for kind, values in zip(kinds[start:start + chunk_size], zip(*columns)):
+            cells = row_cells[kind]
+            for cell, value in zip(cells, values):
+                cell.value = value
+            ws.append(cells)
+
+    if len(df) > 0:
+        ws.auto_filter.ref = f"A1:{get_column_letter(n_cols)}{len(df) + 1}"
+
+
+def _generate_excel_streaming(
+    result_df: pd.DataFrame, conditional_format: bool = False, cube: SummaryCube | None = None,
+) -> bytes:
+    """openpyxl の write_only モードで generate_excel と同じ4シートを書き出す。"""
+    wb = Workbook(write_only=True)
+
+    # --- シート1: サマリ ---
+    with perf_stage("シート: サマリ"):
+        ws1 = wb.create_sheet("サマリ")
+        rows = _summary_sheet_rows(result_df, cube)
+        header_row = rows.index(SUMMARY_HEADERS) + 1
+        _set_column_widths(ws1, _column_widths(pd.DataFrame(rows), include_header=False))
+        ws1.merged_cells.add("A1:F1")
+        for r_idx, row in enumerate(rows, start=1):
+            cells = [WriteOnlyCell(ws1, value=v) for v in row]
+            if r_idx == 1:
+                cells[0].font = Font(bold=True, size=14)
+            elif r_idx == header_row - 1:
+                cells[0].font = Font(bold=True, size=11)
+            elif r_idx == header_row:
+                for cell in cells:
+                    cell.fill = HEADER_FILL
+                    cell.font = HEADER_FONT
+                    cell.border = THIN_BORDER
+            ws1.append(cells)
+
+    # --- シート2〜4 ---
+    for title, df, empty_message in _detail_sheets(result_df):
+        if df.empty and empty_message:
+            ws = wb.create_sheet(title)
+            ws.append([empty_message])
+            continue
+        with perf_stage(f"シート: {title}", rows=len(df)):
+            _stream_df_to_sheet(wb, title, df, conditional_format=conditional_format)
+
+    # write_only モードではシートの XML は save 時に書き出される
+    with perf_stage("xlsx の保存"):
+        buf = io.BytesIO()
+        wb.save(buf)
+    return buf.getvalue()
+
 
+def generate_excel(
+    result_df: pd.DataFrame,
+    streaming: bool | None = None,
+    conditional_format: bool | None = None,
+    cube: SummaryCube | None = None,
+) -> bytes:
+    """Excel レポートを生成する。
+
+    streaming / conditional_format が None のときは、行数が EXCEL_STREAMING_THRESHOLD 以上なら
+    write_only モード・条件付き書式による行の色分けを使う。サマリシートは cube（省略時は作成）から書く。
+    """
+    large = len(result_df) >= EXCEL_STREAMING_THRESHOLD
+    if streaming is None:
+        streaming = large
+    if conditional_format is None:
+        conditional_format = large
+    if streaming:
+        return _generate_excel_streaming(result_df, conditional_format=conditional_format, cube=cube)
+
+    wb = Workbook()
+
+    # --- シート1: サマリ ---
+    with perf_stage("シート: サマリ"):
+        ws1 = wb.active
+        ws1.title = "サマリ"
+        rows = _summary_sheet_rows(result_df, cube)
+        for row in rows:
+            ws1.append(row)
+        ws1.merge_cells(start_row=1, start_column=1, end_row=1, end_column=6)
+        ws1.cell(1, 1).font = Font(bold=True, size=14)
+        header_row = rows.index(SUMMARY_HEADERS) + 1
+        ws1.cell(header_row - 1, 1).font = Font(bold=True, size=11)
+        for c_idx in range(1, len(SUMMARY_HEADERS) + 1):
+            cell = ws1.cell(header_row, c_idx)
+            cell.fill = HEADER_FILL
+            cell.font = HEADER_FONT
+            cell.border = THIN_BORDER
+        _set_column_widths(ws1, _column_widths(pd.DataFrame(rows), include_header=False))
+
+    # --- シート2〜4: 商品別Aging明細 / 期限注意リスト / B2B候補_Shopee未掲載 ---
+    for title, df, empty_message in _detail_sheets(result_df):
+        ws = wb.create_sheet(title)
+        if df.empty and empty_message:
+            ws.append([empty_message])
+            continue
+        with perf_stage(f"シート: {title}", rows=len(df)):
+            _write_df_to_sheet(ws, df)
+            if conditional_format:
+                _add_row_color_rules(ws, list(df.columns), len(df))
+                continue
+            header_map = {col: i + 1 for i, col in enumerate(df.columns)}
+            _color_detail_rows(ws, {
+                "Shopee掲載": header_map.get("Shopee掲載"),
+                "期限ステータス": header_map.get("期限ステータス"),
+                "滞留日数": header_map.get("滞留日数"),
+            }, len(df))
+
+    with perf_stage("xlsx の保存"):
+        buf = io.BytesIO()
+        wb.save(buf)
+    return buf.getvalue()
+
+
+CSV_DATE_COLUMNS = ["最古入庫日", "最新入庫日", "最早期限日"]
+
+
+def _csv_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """CSV 用の表記（● / 空欄、YYYY-MM-DD）に変換する。元の結果はコピーしない。"""
+    changes = {
+        col: chunk[col].map({True: "●", False: ""})
+        for col in ("Shopee掲載", "B2B候補") if col in chunk.columns
+    }
+    for col in CSV_DATE_COLUMNS:
+        if col in chunk.columns:
+            changes[col] = pd.to_datetime(chunk[col]).dt.strftime("%Y-%m-%d").fillna("")
+    return chunk.assign(**changes)
+
+
+def write_csv(result_df: pd.DataFrame, dest, compress: bool = False, chunk_rows: int = CSV_CHUNK_ROWS):
+    """スプレッドシート用 CSV（UTF-8 BOM 付き）を chunk_rows 行ずつ dest に書き出す。
+
+    dest はファイルパスかバイナリのファイルオブジェクト。compress=True なら gzip で圧縮する
+    （mtime を 0 に固定するため、同じ内容なら同じバイト列になる）。
+    """
+    with ExitStack() as stack:
+        out = stack.enter_context(open(dest, "wb")) if isinstance(dest, (str, os.PathLike)) else dest
+        if compress:
+            out = stack.enter_context(gzip.GzipFile(fileobj=out, mode="wb", mtime=0))
+        out.write(codecs.BOM_UTF8)
+        for start in range(0, max(len(result_df), 1), chunk_rows):
+            chunk = _csv_chunk(result_df.iloc[start:start + chunk_rows])
+            chunk.to_csv(out, index=False, header=start == 0, encoding="utf-8")
+
+
+def generate_csv(result_df: pd.DataFrame, compress: bool = False) -> bytes:
+    """スプレッドシート用 CSV を生成する（UTF-8 BOM 付きのバイト列、compress=True なら gzip）。"""
     buf = io.BytesIO()
-    wb.save(buf)
+    write_csv(result_df, buf, compress=compress)
     return buf.getvalue()
 
 
-def generate_csv(result_df: pd.DataFrame) -> str:
-    """スプレッドシート用 CSV を生成する。"""
-    out = result_df.copy()
-    out["Shopee掲載"] = out["Shopee掲載"].map({True: "●", False: ""})
-    out["B2B候補"] = out["B2B候補"].map({True: "●", False: ""})
-    for col in ["最古入庫日", "最新入庫日", "最早期限日"]:
-        if col in out.columns:
-            out[col] = out[col].apply(
-                lambda x: x.strftime("%Y-%m-%d") if pd.notna(x) else ""
+# ---------------------------------------------------------------------------
+# 出力キャッシュ
+# ---------------------------------------------------------------------------
+@st.cache_resource
+def _export_cache() -> LRUCache:
+    """Streamlit の再実行・セッションをまたいで共有する出力キャッシュ。"""
+    return LRUCache(EXPORT_CACHE_MAX_ENTRIES, EXPORT_CACHE_MAX_BYTES)
+
+
+def result_fingerprint(result_df: pd.DataFrame) -> str:
+    """分析結果の内容ハッシュ（列名・型・全セルの値）。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([(col, str(dtype)) for col, dtype in result_df.dtypes.items()]).encode())
+    h.update(pd.util.hash_pandas_object(result_df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def cached_export(
+    kind: str, result_df: pd.DataFrame, fingerprint: str | None = None, cube: SummaryCube | None = None, **options,
+) -> bytes:
+    """generate_excel / generate_csv の結果を、内容ハッシュと出力オプションをキーに再利用する。
+
+    kind は "excel" または "csv"。Excel のサマリには作成日が入るため、日付もキーに含める。
+    cube は結果から決まるのでキーには含めず、Excel のサマリシートにだけ渡す。
+    """
+    key = (
+        kind,
+        fingerprint or result_fingerprint(result_df),
+        datetime.today().strftime("%Y-%m-%d"),
+        tuple(sorted(options.items())),
+    )
+    cache = _export_cache()
+    data = cache.get(key)
+    if data is None:
+        if kind not in ("excel", "csv"):
+            raise ValueError(f"未対応の出力形式です: {kind}")
+        with perf_stage("Excel 生成" if kind == "excel" else "CSV 生成", rows=len(result_df)):
+            if kind == "excel":
+                data = generate_excel(result_df, cube=cube, **options)
+            else:
+                data = generate_csv(result_df, **options)
+        cache.put(key, data)
+    return data
+
+
+# ---------------------------------------------------------------------------
+# 履歴スナップショット
+# ---------------------------------------------------------------------------
+# snapshot_summary は日付 × Aging × 期限ステータスの集計で、保存時に作っておく。
+# 推移グラフは明細（snapshots）を走査せず、この表だけを読む。
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_date TEXT NOT NULL,
+    product_code TEXT NOT NULL,
+    product_name TEXT,
+    aging_days INTEGER,
+    aging_category TEXT,
+    expiry_status TEXT,
+    total_qty REAL,
+    earliest_expiry TEXT,
+    shopee INTEGER,
+    b2b INTEGER,
+    PRIMARY KEY (snapshot_date, product_code)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_snapshots_product ON snapshots (product_code, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_snapshots_aging ON snapshots (aging_category, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_snapshots_status ON snapshots (expiry_status, snapshot_date);
+CREATE TABLE IF NOT EXISTS snapshot_summary (
+    snapshot_date TEXT NOT NULL,
+    aging_category TEXT NOT NULL,
+    expiry_status TEXT NOT NULL,
+    sku_count INTEGER,
+    total_qty REAL,
+    PRIMARY KEY (snapshot_date, aging_category, expiry_status)
+) WITHOUT ROWID;
+"""
+
+
+def _snapshot_connection(path: str = SNAPSHOT_DB_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SNAPSHOT_SCHEMA)
+    return conn
+
+
+def _snapshot_rows(result_df: pd.DataFrame, snapshot_date: str) -> list[tuple]:
+    """executemany に渡す行。列ごとに Python の値へ変換してから zip する。"""
+    earliest = result_df["最早期限日"].dt.strftime("%Y-%m-%d").astype(object)
+    earliest = earliest.where(result_df["最早期限日"].notna(), None)
+    return list(zip(
+        [snapshot_date] * len(result_df),
+        result_df["Product Code"].astype(str).tolist(),
+        result_df["商品名"].astype(object).where(result_df["商品名"].notna(), None).tolist(),
+        result_df["滞留日数"].astype(int).tolist(),
+        result_df["Agingカテゴリ"].astype(str).tolist(),
+        result_df["期限ステータス"].astype(str).tolist(),
+        result_df["合計数量"].astype(float).tolist(),
+        earliest.tolist(),
+        result_df["Shopee掲載"].astype(int).tolist(),
+        result_df["B2B候補"].astype(int).tolist(),
+    ))
+
+
+def save_snapshot(result_df: pd.DataFrame, snapshot_date: str | None = None, path: str = SNAPSHOT_DB_PATH) -> int:
+    """分析結果を1トランザクションで保存する。同じ日付の既存スナップショットは置き換える。"""
+    snapshot_date = snapshot_date or datetime.today().strftime("%Y-%m-%d")
+    rows = _snapshot_rows(result_df, snapshot_date)
+    conn = _snapshot_connection(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM snapshots WHERE snapshot_date = ?", (snapshot_date,))
+            conn.execute("DELETE FROM snapshot_summary WHERE snapshot_date = ?", (snapshot_date,))
+            conn.executemany("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute(
+                "INSERT INTO snapshot_summary "
+                "SELECT snapshot_date, aging_category, expiry_status, COUNT(*), SUM(total_qty) "
+                "FROM snapshots WHERE snapshot_date = ? "
+                "GROUP BY aging_category, expiry_status",
+                (snapshot_date,),
             )
-    return out.to_csv(index=False)
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def load_snapshot_trend(since: str | None = None, path: str = SNAPSHOT_DB_PATH) -> pd.DataFrame:
+    """日付 × Aging × 期限ステータスごとの SKU数・合計数量。"""
+    conn = _snapshot_connection(path)
+    try:
+        return pd.read_sql_query(
+            "SELECT snapshot_date AS 日付, aging_category AS Agingカテゴリ, expiry_status AS 期限ステータス, "
+            "sku_count AS SKU数, total_qty AS 合計数量 "
+            "FROM snapshot_summary WHERE snapshot_date >= ? ORDER BY snapshot_date",
+            conn,
+            params=(since or "",),
+        )
+    finally:
+        conn.close()
+
+
+def load_sku_history(product_code: str, path: str = SNAPSHOT_DB_PATH) -> pd.DataFrame:
+    """1つの Product Code の日付ごとの滞留日数・Aging・期限ステータス。"""
+    conn = _snapshot_connection(path)
+    try:
+        return pd.read_sql_query(
+            "SELECT snapshot_date AS 日付, product_name AS 商品名, aging_days AS 滞留日数, "
+            "aging_category AS Agingカテゴリ, expiry_status AS 期限ステータス, total_qty AS 合計数量, "
+            "earliest_expiry AS 最早期限日 "
+            "FROM snapshots WHERE product_code = ? ORDER BY snapshot_date",
+            conn,
+            params=(product_code,),
+        )
+    finally:
+        conn.close()
 
 
 # ---------------------------------------------------------------------------
 # Slack 通知
 # ---------------------------------------------------------------------------
-def _build_summary_text(result_df: pd.DataFrame) -> str:
+def _build_summary_text(result_df: pd.DataFrame, cube: SummaryCube | None = None) -> str:
     """Slack 投稿用のサマリテキスト（ファイルと一緒に投稿するメッセージ）。"""
     today_str = datetime.today().strftime("%Y-%m-%d %H:%M")
-    total_sku = len(result_df)
-    shopee_count = int(result_df["Shopee掲載"].sum())
-    expiry_warn = int(((result_df["期限ステータス"] == "期限切れ") | (result_df["期限ステータス"] == "3ヶ月以内")).sum())
-    b2b_count = int(result_df["B2B候補"].sum())
+    cube = cube or SummaryCube(result_df)
+    kpis = cube.kpis()
+    total_sku, shopee_count = kpis["total_sku"], kpis["shopee_count"]
+    expiry_warn, b2b_count = kpis["expiry_warn"], kpis["b2b_count"]
 
-    cat_order = [label for _, _, label in AGING_BINS]
+    aging_counts = cube.aging_summary().set_index("Agingカテゴリ")["SKU数"]
     aging_lines = []
-    for cat in cat_order:
-        cnt = int((result_df["Agingカテゴリ"] == cat).sum())
+    for cat in AGING_LABELS:
+        cnt = int(aging_counts.get(cat, 0))
         if cnt > 0:
             aging_lines.append(f"    {cat}: {cnt:,} SKU")
     aging_text = "\n".join(aging_lines) if aging_lines else "    データなし"
@@ -707,78 +2415,469 @@ def _build_summary_text(result_df: pd.DataFrame) -> str:
     )
 
 
-def send_slack_notification(
-    bot_token: str, channel_id: str, result_df: pd.DataFrame, excel_bytes: bytes,
-) -> tuple[bool, str]:
-    """Slack Bot Token で Excel ファイル + サマリメッセージを送信する。"""
-    token = bot_token.strip()
-    ch = channel_id.strip()
-    if not token.startswith("xoxb-"):
-        return False, "Bot Token が正しくありません。xoxb- で始まるトークンを入力してください"
-    if not ch:
-        return False, "チャンネルIDが未入力です"
-
-    today_str = datetime.today().strftime("%Y%m%d_%H%M")
-    filename = f"aging_report_{today_str}.xlsx"
-    summary = _build_summary_text(result_df)
-
-    # --- Step 1: files.getUploadURLExternal で署名付きURLを取得 ---
-    params = json.dumps({"filename": filename, "length": len(excel_bytes)}).encode()
-    try:
-        req = Request(
-            f"https://slack.com/api/files.getUploadURLExternal"
-            f"?filename={filename}&length={len(excel_bytes)}",
-            method="GET",
-            headers={"Authorization": f"Bearer {token}"},
-        )
-        with urlopen(req, timeout=15) as resp:
-            body = json.loads(resp.read().decode())
-        if not body.get("ok"):
-            return False, f"Slack API エラー (getUploadURL): {body.get('error', body)}"
-        upload_url = body["upload_url"]
-        file_id = body["file_id"]
-    except Exception as e:
-        return False, f"アップロードURL取得に失敗: {e}"
+SLACK_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slack_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    comment TEXT NOT NULL,
+    payload BLOB,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    file_id TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_slack_outbox_due ON slack_outbox (status, next_attempt_at);
+"""
+
+# 送信ジョブの状態 → 画面表示
+SLACK_JOB_LABELS = {
+    "queued": "⏳ 待機中",
+    "sending": "📤 送信中",
+    "retry": "🔁 再試行待ち",
+    "sent": "✅ 送信済み",
+    "failed": "❌ 失敗",
+}
+SLACK_ACTIVE_STATUSES = ("queued", "sending", "retry")
+
+
+class SlackDeliveryError(Exception):
+    """Slack への送信失敗。retryable なら retry_after 秒（なければバックオフ）後に再送する。"""
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: float | None = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class KeepAliveHTTP:
+    """ホストごとに http.client の接続を保持し、Keep-Alive で使い回す。
+
+    1 つのスレッドから使う前提。使い回した接続がサーバー側で閉じられていた場合だけ、
+    新しい接続で1回送り直す（リクエストはサーバーに届いていない）。
+    """
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self._connections: dict[tuple[str, str], http.client.HTTPConnection] = {}
+        self.opened = 0
+
+    def _connection(self, scheme: str, netloc: str) -> tuple[http.client.HTTPConnection, bool]:
+        conn = self._connections.get((scheme, netloc))
+        if conn is not None:
+            return conn, True
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        conn = cls(netloc, timeout=self.timeout)
+        self._connections[(scheme, netloc)] = conn
+        self.opened += 1
+        return conn, False
+
+    def _discard(self, scheme: str, netloc: str):
+        conn = self._connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def request(
+        self, method: str, url: str, body: bytes | None = None, headers: dict | None = None,
+    ) -> tuple[int, dict, bytes]:
+        parts = urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        while True:
+            conn, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._discard(parts.scheme, parts.netloc)
+                if reused:
+                    continue
+                raise
+            except Exception:
+                self._discard(parts.scheme, parts.netloc)
+                raise
+            if resp.will_close:
+                self._discard(parts.scheme, parts.netloc)
+            return resp.status, {k.lower(): v for k, v in resp.getheaders()}, data
+
+    def close(self):
+        for scheme, netloc in list(self._connections):
+            self._discard(scheme, netloc)
+
 
-    # --- Step 2: upload_url に PUT でファイルを送信 ---
+def _retry_after(headers: dict) -> float | None:
     try:
-        req2 = Request(
-            upload_url,
-            data=excel_bytes,
-            method="POST",
-            headers={"Content-Type": "application/octet-stream"},
+        return max(0.0, float(headers.get("retry-after", "")))
+    except ValueError:
+        return None
+
+
+class SlackClient:
+    """files.getUploadURLExternal → アップロード → files.completeUploadExternal の3段階で送信する。"""
+
+    def __init__(self, token: str, api_base: str = SLACK_API_BASE, http: KeepAliveHTTP | None = None):
+        self.token = token
+        self.api_base = api_base.rstrip("/")
+        self.http = http or KeepAliveHTTP()
+
+    def _send(self, step: str, method: str, url: str, body: bytes | None = None, headers: dict | None = None) -> bytes:
+        try:
+            status, resp_headers, data = self.http.request(method, url, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            raise SlackDeliveryError(f"{step} の通信に失敗: {e}", retryable=True) from e
+        if status == 429 or status >= 500:
+            raise SlackDeliveryError(
+                f"{step} が一時的に失敗: status={status}", retryable=True, retry_after=_retry_after(resp_headers),
+            )
+        if status not in (200, 201):
+            raise SlackDeliveryError(f"{step} に失敗: status={status}")
+        return data
+
+    def _api(self, name: str, method: str = "GET", params: dict | None = None, payload: dict | None = None) -> dict:
+        url = f"{self.api_base}/{name}" + (f"?{urlencode(params)}" if params else "")
+        headers = {"Authorization": f"Bearer {self.token}"}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode()
+            headers["Content-Type"] = "application/json; charset=utf-8"
+        data = self._send(name, method, url, body, headers)
+        try:
+            result = json.loads(data.decode())
+        except ValueError as e:
+            raise SlackDeliveryError(f"Slack API の応答を解釈できません ({name})", retryable=True) from e
+        if not result.get("ok"):
+            error = result.get("error", result)
+            raise SlackDeliveryError(
+                f"Slack API エラー ({name}): {error}", retryable=error in ("ratelimited", "internal_error"),
+            )
+        return result
+
+    def upload_file(self, filename: str, data: bytes) -> str:
+        """ファイルをアップロードし、共有前の file_id を返す。"""
+        body = self._api("files.getUploadURLExternal", params={"filename": filename, "length": len(data)})
+        self._send(
+            "ファイルアップロード", "POST", body["upload_url"], data,
+            {"Content-Type": "application/octet-stream"},
         )
-        with urlopen(req2, timeout=30) as resp2:
-            if resp2.status not in (200, 201):
-                return False, f"ファイルアップロード失敗: status={resp2.status}"
-    except Exception as e:
-        return False, f"ファイルアップロード失敗: {e}"
+        return body["file_id"]
 
-    # --- Step 3: files.completeUploadExternal でチャンネルに共有 ---
-    try:
-        complete_payload = json.dumps({
+    def complete_upload(self, file_id: str, filename: str, channel: str, comment: str):
+        self._api("files.completeUploadExternal", method="POST", payload={
             "files": [{"id": file_id, "title": filename}],
-            "channel_id": ch,
-            "initial_comment": summary,
-        }).encode()
-        req3 = Request(
-            "https://slack.com/api/files.completeUploadExternal",
-            data=complete_payload,
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json; charset=utf-8",
-            },
-        )
-        with urlopen(req3, timeout=15) as resp3:
-            body3 = json.loads(resp3.read().decode())
-        if not body3.get("ok"):
-            return False, f"Slack API エラー (completeUpload): {body3.get('error', body3)}"
-    except Exception as e:
-        return False, f"ファイル共有に失敗: {e}"
+            "channel_id": channel,
+            "initial_comment": comment,
+        })
+
+
+def _validate_slack_target(bot_token: str, channel_id: str) -> str | None:
+    if not bot_token.strip().startswith("xoxb-"):
+        return "Bot Token が正しくありません。xoxb- で始まるトークンを入力してください"
+    if not channel_id.strip():
+        return "チャンネルIDが未入力です"
+    return None
+
 
+def _slack_filename() -> str:
+    return f"aging_report_{datetime.today().strftime('%Y%m%d_%H%M')}.xlsx"
+
+
+def send_slack_notification(
+    bot_token: str, channel_id: str, result_df: pd.DataFrame, excel_bytes: bytes,
+    api_base: str = SLACK_API_BASE, cube: SummaryCube | None = None,
+) -> tuple[bool, str]:
+    """Slack Bot Token で Excel ファイル + サマリメッセージを送信する（その場で1回だけ送る）。"""
+    error = _validate_slack_target(bot_token, channel_id)
+    if error:
+        return False, error
+    filename = _slack_filename()
+    client = SlackClient(bot_token.strip(), api_base)
+    try:
+        file_id = client.upload_file(filename, excel_bytes)
+        client.complete_upload(file_id, filename, channel_id.strip(), _build_summary_text(result_df, cube))
+    except SlackDeliveryError as e:
+        return False, str(e)
+    finally:
+        client.http.close()
     return True, "Slack にExcelファイル + サマリを送信しました"
 
 
+class SlackDeliveryWorker:
+    """Slack への送信ジョブを SQLite の送信箱に保存し、バックグラウンドのスレッドで送る。
+
+    429・5xx・通信エラーは Retry-After（なければ指数バックオフ）の後に再送し、max_attempts 回で諦める。
+    アップロード済みのファイルは file_id を保存し、再送時は共有の段階からやり直す。
+    Bot Token は送信箱に保存しない。再起動でトークンが失われたジョブは SLACK_BOT_TOKEN があればそれで送り、
+    なければ失敗にする（別の利用者が送信したトークンは使わない）。
+    """
+
+    def __init__(
+        self,
+        path: str = SLACK_OUTBOX_DB_PATH,
+        api_base: str = SLACK_API_BASE,
+        max_attempts: int = SLACK_MAX_ATTEMPTS,
+        backoff: float = SLACK_RETRY_BACKOFF,
+        max_delay: float = SLACK_RETRY_MAX_DELAY,
+        default_token: str = "",
+    ):
+        self.path = path
+        self.api_base = api_base
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.http = KeepAliveHTTP()
+        self._tokens: dict[int, str] = {}
+        self._default_token = default_token.strip()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SLACK_OUTBOX_SCHEMA)
+        return conn
+
+    def _update(self, job_id: int, **fields):
+        fields["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    f"UPDATE slack_outbox SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                    [*fields.values(), job_id],
+                )
+        finally:
+            conn.close()
+
+    def submit(self, bot_token: str, channel_id: str, filename: str, payload: bytes, comment: str) -> int:
+        """送信ジョブを送信箱に入れ、ジョブ ID を返す。送信はバックグラウンドで行う。"""
+        now = datetime.now().isoformat(timespec="seconds")
+        # トークンを登録し終えるまで、送信スレッドの _token_for を待たせる
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    job_id = conn.execute(
+                        "INSERT INTO slack_outbox (created_at, updated_at, channel, filename, comment, payload, "
+                        "status, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (now, now, channel_id.strip(), filename, comment, payload, time.time()),
+                    ).lastrowid
+            finally:
+                conn.close()
+            self._tokens[job_id] = bot_token.strip()
+        self._wake.set()
+        return job_id
+
+    def jobs(self, limit: int = 10, job_ids: list[int] | None = None) -> list[dict]:
+        """直近のジョブ。job_ids を渡すとそのジョブだけに絞る（セッションが送信したジョブの表示用）。"""
+        if job_ids is not None and not job_ids:
+            return []
+        where = f"WHERE id IN ({', '.join('?' * len(job_ids))}) " if job_ids else ""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, created_at, updated_at, channel, filename, status, attempts, next_attempt_at, last_error "
+                f"FROM slack_outbox {where}ORDER BY id DESC LIMIT ?",
+                (*(job_ids or ()), limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def job(self, job_id: int) -> dict | None:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT id, channel, filename, status, attempts, next_attempt_at, file_id, last_error "
+                "FROM slack_outbox WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    def _token_for(self, job_id: int) -> str:
+        with self._lock:
+            return self._tokens.get(job_id) or self._default_token
+
+    def _retry_delay(self, attempts: int, retry_after: float | None) -> float:
+        if retry_after is not None:
+            return retry_after
+        return min(self.max_delay, self.backoff * 2 ** (attempts - 1))
+
+    def _deliver(self, job: sqlite3.Row):
+        job_id = job["id"]
+        token = self._token_for(job_id)
+        if not token:
+            self._update(
+                job_id, status="failed",
+                last_error="再起動で Bot Token が失われたため送信できませんでした。もう一度送信してください",
+            )
+            self._forget(job_id)
+            return
+        attempts = job["attempts"] + 1
+        self._update(job_id, status="sending", attempts=attempts)
+        client = SlackClient(token, self.api_base, self.http)
+        file_id = job["file_id"]
+        try:
+            if not file_id:
+                file_id = client.upload_file(job["filename"], job["payload"])
+                self._update(job_id, file_id=file_id)
+            client.complete_upload(file_id, job["filename"], job["channel"], job["comment"])
+        except Exception as e:
+            # 想定外の例外（応答の形の違い・送信箱の書き込み失敗など）も送信中のまま残さず、再送の対象にする
+            if isinstance(e, SlackDeliveryError):
+                retryable, retry_after, error = e.retryable, e.retry_after, str(e)
+            else:
+                logging.getLogger("inventory_aging.slack").exception("Slack 送信ジョブ #%s でエラー", job_id)
+                retryable, retry_after, error = True, None, f"予期しないエラー: {type(e).__name__}: {e}"
+            if retryable and attempts < self.max_attempts:
+                delay = self._retry_delay(attempts, retry_after)
+                self._update(job_id, status="retry", next_attempt_at=time.time() + delay, last_error=error)
+            else:
+                self._update(job_id, status="failed", last_error=error)
+                self._forget(job_id)
+            return
+        # 送信済みのジョブは Excel 本体を消して、状態だけを残す
+        self._update(job_id, status="sent", payload=None, last_error=None)
+        self._forget(job_id)
+
+    def _forget(self, job_id: int):
+        with self._lock:
+            self._tokens.pop(job_id, None)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM slack_outbox WHERE status IN ('sent', 'failed') AND id NOT IN ("
+                    "SELECT id FROM slack_outbox WHERE status IN ('sent', 'failed') ORDER BY id DESC LIMIT ?)",
+                    (SLACK_OUTBOX_KEEP,),
+                )
+        finally:
+            conn.close()
+
+    def run_pending(self) -> float | None:
+        """期限の来たジョブを古い順に送り、次のジョブまでの秒数（なければ None）を返す。"""
+        while not self._stop.is_set():
+            conn = self._connect()
+            try:
+                job = conn.execute(
+                    "SELECT * FROM slack_outbox WHERE status IN ('queued', 'retry') AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at, id LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                following = conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM slack_outbox WHERE status IN ('queued', 'retry')"
+                ).fetchone()[0]
+            finally:
+                conn.close()
+            if job is None:
+                return None if following is None else max(0.0, following - time.time())
+            self._deliver(job)
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.run_pending()
+            except Exception:
+                logging.getLogger("inventory_aging.slack").exception("Slack 送信ワーカーでエラー")
+                delay = self.max_delay
+            self._wake.wait(timeout=delay)
+            self._wake.clear()
+
+    def start(self):
+        """送信中・待機中のまま終了したジョブをすぐ処理し直すようにし、送信スレッドを開始する。"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE slack_outbox SET status = 'queued', next_attempt_at = ? "
+                    "WHERE status IN ('sending', 'queued')",
+                    (time.time(),),
+                )
+        finally:
+            conn.close()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="slack-delivery", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = 5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.http.close()
+
+
+@st.cache_resource
+def slack_worker() -> SlackDeliveryWorker:
+    """全セッションで共有する Slack 送信ワーカー（初回に送信箱の残りの送信を再開する）。"""
+    worker = SlackDeliveryWorker(default_token=os.getenv("SLACK_BOT_TOKEN", ""))
+    worker.start()
+    return worker
+
+
+def queue_slack_notification(
+    bot_token: str, channel_id: str, result_df: pd.DataFrame, excel_bytes: bytes,
+    worker: SlackDeliveryWorker | None = None, cube: SummaryCube | None = None,
+) -> tuple[bool, str, int | None]:
+    """Excel ファイル + サマリの送信を送信箱に入れる。送信の結果はジョブの状態で確認する。"""
+    error = _validate_slack_target(bot_token, channel_id)
+    if error:
+        return False, error, None
+    worker = worker or slack_worker()
+    job_id = worker.submit(
+        bot_token, channel_id, _slack_filename(), excel_bytes, _build_summary_text(result_df, cube),
+    )
+    return True, f"Slack への送信を受け付けました（ジョブ #{job_id}）", job_id
+
+
+# ---------------------------------------------------------------------------
+# 明細ビュー
+# ---------------------------------------------------------------------------
+class DetailView:
+    """商品別 Aging 明細の表示用フレームと、フィルタごとの真偽マスクを分析結果ごとに1回だけ作る。
+
+    フィルタの組み合わせはマスクの論理積で求め、表示用フレームからは1回だけ切り出す。
+    """
+
+    def __init__(self, result_df: pd.DataFrame, fingerprint: str | None = None):
+        self.fingerprint = fingerprint
+        self.total = len(result_df)
+        display = result_df.copy()
+        display["Shopee掲載"] = np.where(result_df["Shopee掲載"], "●", "")
+        display["B2B候補"] = np.where(result_df["B2B候補"], "●", "")
+        display["期限注意"] = np.where(result_df["期限ステータス"].isin(["期限切れ", "3ヶ月以内"]), "⚠", "")
+        self.display = display
+
+        aging = result_df["Agingカテゴリ"].to_numpy()
+        self.aging_masks = {label: aging == label for label in AGING_LABELS}
+        shopee = result_df["Shopee掲載"].to_numpy(dtype=bool)
+        b2b = result_df["B2B候補"].to_numpy(dtype=bool)
+        self.shopee_masks = {"掲載あり": shopee, "未掲載": ~shopee}
+        self.b2b_masks = {"候補のみ": b2b, "候補外": ~b2b}
+
+    def filter(self, aging_filter: list, shopee_filter: str, b2b_filter: str) -> pd.DataFrame:
+        mask = np.zeros(self.total, dtype=bool)
+        for label in aging_filter:
+            mask |= self.aging_masks.get(label, False)
+        if shopee_filter in self.shopee_masks:
+            mask &= self.shopee_masks[shopee_filter]
+        if b2b_filter in self.b2b_masks:
+            mask &= self.b2b_masks[b2b_filter]
+        return self.display.iloc[np.flatnonzero(mask)]
+
+
 # ---------------------------------------------------------------------------
 # UI ヘルパー
 # ---------------------------------------------------------------------------
@@ -792,6 +2891,74 @@ def render_section_header(icon: str, title: str, color: str = "blue"):
     )
 
 
+def render_parse_cache_stats(slot):
+    stats = _parse_cache().stats()
+    disk = disk_cache_stats()
+    slot.caption(
+        f"📦 読込キャッシュ: ヒット {stats['hits']:,} / ミス {stats['misses']:,}"
+        f"（{stats['entries']:,}件・{stats['bytes'] / 1024 / 1024:.1f} MB）"
+        f" / ディスク {disk['files']:,}件・{disk['bytes'] / 1024 / 1024:.1f} MB"
+    )
+
+
+def render_slack_jobs(worker: SlackDeliveryWorker, job_ids: list[int]):
+    """このセッションが送信したジョブの状態。送信待ちのジョブがある間は数秒ごとに表示を更新する。
+
+    送信箱は全セッションで共有するため、他の利用者のチャンネルやファイル名は表示しない。
+    """
+    if not job_ids:
+        return
+    pending = any(job["status"] in SLACK_ACTIVE_STATUSES for job in worker.jobs(job_ids=job_ids))
+
+    @st.fragment(run_every=2 if pending else None)
+    def _jobs_table():
+        jobs = worker.jobs(job_ids=job_ids)
+        if not jobs:
+            return
+        now = time.time()
+        rows = []
+        for job in jobs:
+            note = job["last_error"] or ""
+            if job["status"] == "retry":
+                note = f"{max(0, job['next_attempt_at'] - now):.0f} 秒後に再送: {note}"
+            rows.append({
+                "ジョブ": f"#{job['id']}",
+                "状態": SLACK_JOB_LABELS.get(job["status"], job["status"]),
+                "チャンネル": job["channel"],
+                "ファイル": job["filename"],
+                "試行": job["attempts"],
+                "更新": job["updated_at"],
+                "詳細": note,
+            })
+        st.caption("📮 Slack 送信状況（直近10件）")
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+    _jobs_table()
+
+
+def render_perf_panel(timer: StageTimer | None):
+    """この実行で計測した段階（なければ直近の分析）の表。"""
+    records = timer.records if timer is not None and timer.records else st.session_state.get("perf_records")
+    if not records:
+        return
+    with st.expander("⏱ パフォーマンス"):
+        table = pd.DataFrame([
+            {
+                "段階": "　" * r["depth"] + r["stage"],
+                "時間(秒)": r["seconds"],
+                "行数": r["rows"],
+                "ピークメモリ(MB)": r["peak_mb"],
+            }
+            for r in records
+        ])
+        st.dataframe(table, use_container_width=True, hide_index=True)
+        total = sum(r["seconds"] or 0 for r in records if r["depth"] == 0)
+        st.caption(
+            f"合計 {total:.2f} 秒（最上位の段階の合計）。ピークメモリは tracemalloc による段階開始時からの増分"
+            + ("" if PERF_TRACE_MEMORY else "（PERF_TRACE_MEMORY=1 で計測）")
+        )
+
+
 def render_kpi_cards(total_sku: int, shopee_count: int, expiry_warn: int, b2b_count: int):
     st.markdown(f"""
     <div class="kpi-grid">
@@ -822,7 +2989,7 @@ def render_kpi_cards(total_sku: int, shopee_count: int, expiry_warn: int, b2b_co
 # ---------------------------------------------------------------------------
 # Streamlit UI
 # ---------------------------------------------------------------------------
-def main():
+def render_app():
     st.set_page_config(page_title="在庫Aging分析", page_icon="📦", layout="wide")
     st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
@@ -836,23 +3003,46 @@ def main():
         unsafe_allow_html=True,
     )
 
-    cat_order = [label for _, _, label in AGING_BINS]
-
     # --- サイドバー ---
     with st.sidebar:
         st.markdown("### 📂 ファイル")
-        inv_file = st.file_uploader(
-            "在庫リスト（Excel）",
+        inv_files = st.file_uploader(
+            "在庫リスト（Excel・倉庫ごとに複数可）",
             type=["xlsx", "xls"],
-            accept_multiple_files=False,
+            accept_multiple_files=True,
             key="inv",
-        )
+        ) or []
         shopee_files = st.file_uploader(
             "Shopee商品リスト（複数可）",
             type=["xlsx", "xls"],
             accept_multiple_files=True,
             key="shopee",
         )
+        # カタログはショップ単位で置き換えるため、ショップ名はファイル名ではなく明示的に入力してもらう
+        shopee_shops = [
+            st.text_input(
+                f"ショップ名（{f.name}）",
+                key=f"shopee_shop_{i}_{f.name}",
+                placeholder="例: TH本店",
+                help="カタログではこのショップの登録内容をこのファイルで置き換えます。空欄ならカタログに保存しません",
+            )
+            for i, f in enumerate(shopee_files or [])
+        ]
+        use_catalog = st.checkbox(
+            "保存済みカタログで判定",
+            value=False,
+            help="これまでに取り込んだ全ショップの Shopee 商品で判定します（アップロード不要）",
+            key="use_shopee_catalog",
+        )
+        catalog = ShopeeCatalog()
+        try:
+            catalog_stats = catalog.stats()
+            st.caption(
+                f"🗂 カタログ: {catalog_stats['entries']:,}件・{catalog_stats['shops']:,}ショップ"
+                + (f"（最終取込 {catalog_stats['last_seen']}）" if catalog_stats["last_seen"] else "")
+            )
+        except sqlite3.Error as e:
+            st.caption(f"🗂 カタログを開けません: {e}")
 
         st.markdown("---")
         st.markdown("### ⚙ オプション")
@@ -861,11 +3051,31 @@ def main():
             value=False,
             help="PICKING KEY7 が空欄の行も分析対象に含めます",
         )
+        stream_inventory = st.checkbox(
+            "在庫リストを行単位で読込",
+            value=False,
+            help="在庫リストを1行ずつ読み、EC 対象の行の分析に使う列だけを保持します。"
+                 "全チャネル分の大きなファイル向けで、メモリは少なくて済みますが読み込みは遅くなります",
+        )
+        lean = st.checkbox(
+            "省メモリモード",
+            value=False,
+            help="明細の文字列・ラベル・数値列を小さい型に変換し、段階ごとのメモリ使用量を表示します",
+        )
+        warehouse_breakdown = st.checkbox(
+            "倉庫別の数量を表示",
+            value=False,
+            help="在庫リストを複数アップロードしたとき、ファイル（倉庫）ごとの数量を「倉庫別数量」列に表示します",
+        )
+        parse_cache_slot = st.empty()
+        if st.button("🗑 読込キャッシュを削除", key="clear_parse_cache"):
+            clear_parse_caches()
+        render_parse_cache_stats(parse_cache_slot)
 
         st.markdown("---")
         st.markdown("### 🔍 明細フィルタ")
         aging_filter = st.multiselect(
-            "Aging カテゴリ", options=cat_order, default=cat_order, key="aging_filter",
+            "Aging カテゴリ", options=AGING_LABELS, default=AGING_LABELS, key="aging_filter",
         )
         shopee_filter = st.selectbox(
             "Shopee掲載", ["すべて", "掲載あり", "未掲載"], key="shopee_filter",
@@ -904,30 +3114,61 @@ def main():
         st.session_state["result"] = None
 
     if run_btn:
-        if inv_file is None:
+        if not inv_files:
             st.error("在庫リストをアップロードしてください。")
             return
+        # 在庫リストが複数なら、ファイルごとの読込・部分集計をワーカープロセスで並列に行う
+        multi_inventory = len(inv_files) > 1
+
+        timer = _active_timer.get()
+        if timer is not None:
+            timer.context.update({
+                "inventory_files": [f.name for f in inv_files],
+                "inventory_bytes": sum(f.size for f in inv_files),
+                "shopee_files": [f.name for f in shopee_files or []],
+                "shopee_bytes": sum(f.size for f in shopee_files or []),
+                "options": {
+                    "include_blank_key7": include_blank_key7, "stream_inventory": stream_inventory, "lean": lean,
+                    "use_catalog": use_catalog,
+                    "warehouse_breakdown": warehouse_breakdown, "inventory_workers": INVENTORY_WORKERS,
+                },
+            })
 
         # データ読み込み
-        try:
-            with st.spinner("在庫リストを読み込み中..."):
-                inv_df = load_inventory(inv_file)
-        except ValueError as e:
-            st.error(str(e))
-            return
-        except Exception as e:
-            st.error(
-                f"在庫リストの読み込み中に予期しないエラーが発生しました。\n\n"
-                f"ファイルが正しい Excel 形式（.xlsx）か確認してください。\n\n詳細: {e}"
-            )
-            return
+        with st.spinner("在庫リスト・Shopee商品リストを読み込み中..."):
+            if multi_inventory:
+                with perf_stage("ファイル読込（Shopee）"):
+                    inv_future = None
+                    shopee_future = (
+                        _run_now(load_shopee_files, shopee_files, LOAD_WORKERS, shopee_shops) if shopee_files else None
+                    )
+            else:
+                with perf_stage("ファイル読込（在庫・Shopee）") as load_record:
+                    inv_future, shopee_future = load_inputs(
+                        inv_files[0], shopee_files, stream=stream_inventory, include_blank_key7=include_blank_key7,
+                        shopee_shops=shopee_shops,
+                    )
+
+        inv_df = None
+        if inv_future is not None:
+            try:
+                inv_df = inv_future.result()
+                load_record["rows"] = len(inv_df)
+            except ValueError as e:
+                st.error(str(e))
+                return
+            except Exception as e:
+                st.error(
+                    f"在庫リストの読み込み中に予期しないエラーが発生しました。\n\n"
+                    f"ファイルが正しい Excel 形式（.xlsx）か確認してください。\n\n詳細: {e}"
+                )
+                return
 
         shopee_df = None
-        if shopee_files:
+        if shopee_future is not None:
             try:
-                with st.spinner("Shopee商品リストを読み込み中..."):
-                    shopee_df = load_shopee_files(shopee_files)
-                    st.sidebar.success(f"Shopee: {len(shopee_df):,}件")
+                shopee_df = shopee_future.result()
+                st.sidebar.success(f"Shopee: {len(shopee_df):,}件")
             except ValueError as e:
                 st.error(str(e))
                 return
@@ -937,18 +3178,62 @@ def main():
                     f"Shopee管理画面からエクスポートした Excel ファイルか確認してください。\n\n詳細: {e}"
                 )
                 return
-
-        with st.spinner("分析処理中..."):
-            result = run_analysis(inv_df, shopee_df, include_blank_key7=include_blank_key7)
+            if not all(shop.strip() for shop in shopee_shops):
+                st.sidebar.info("ショップ名が未入力の Shopee ファイルはカタログに保存していません。")
+            try:
+                catalog.upsert(shopee_df)
+            except sqlite3.Error as e:
+                st.sidebar.warning(f"Shopee カタログの更新に失敗しました: {e}")
+        render_parse_cache_stats(parse_cache_slot)
+        analysis_catalog = catalog if use_catalog else None
+        memory_report = [] if lean else None
+
+        with st.spinner("分析処理中..."), perf_stage("分析", rows=None if inv_df is None else len(inv_df)):
+            if multi_inventory:
+                try:
+                    result = run_analysis_files(
+                        inv_files, shopee_df, include_blank_key7=include_blank_key7, catalog=analysis_catalog,
+                        stream=stream_inventory, lean=lean, warehouse_breakdown=warehouse_breakdown,
+                        memory_report=memory_report,
+                    )
+                except ValueError as e:
+                    st.error(str(e))
+                    return
+                except Exception as e:
+                    st.error(
+                        f"在庫リストの集計中に予期しないエラーが発生しました。\n\n"
+                        f"ファイルが正しい Excel 形式（.xlsx）か確認してください。\n\n詳細: {e}"
+                    )
+                    return
+            else:
+                result = run_analysis(
+                    inv_df, shopee_df, include_blank_key7=include_blank_key7, catalog=analysis_catalog,
+                    lean=lean, memory_report=memory_report,
+                )
 
         if result.empty:
             st.warning("分析結果が0件です。入力データを確認してください。")
             return
 
         st.session_state["result"] = result
+        st.session_state["result_fingerprint"] = result_fingerprint(result)
+        with perf_stage("サマリ集計", rows=len(result)):
+            st.session_state["summary_cube"] = SummaryCube(result, st.session_state["result_fingerprint"])
+        st.session_state["memory_report"] = memory_report
+        # GTIN で判定していない（Shopee 商品リストもカタログもない）ときは、社内コードが全件並ぶため作らない
+        st.session_state["gtin_report"] = None
+        if analysis_catalog is not None or (shopee_df is not None and not shopee_df.empty):
+            with perf_stage("GTIN 検証", rows=len(result)):
+                st.session_state["gtin_report"] = gtin_validation_report(result["Product Code"], shopee_df)
+        try:
+            with perf_stage("履歴の保存", rows=len(result)):
+                save_snapshot(result)
+        except sqlite3.Error as e:
+            st.sidebar.warning(f"履歴の保存に失敗しました: {e}")
 
     # --- session_state から結果を取得して表示 ---
     result = st.session_state.get("result")
+    fingerprint = st.session_state.get("result_fingerprint")
     if result is None:
         st.markdown(
             '<div class="welcome-area">'
@@ -969,7 +3254,7 @@ def main():
         flow_cols = st.columns(4)
         flow_steps = [
             ("1️⃣ データ読込", [
-                "在庫リスト (.xlsx) を読込",
+                "在庫リスト (.xlsx) を読込（必要列のみ / calamine使用）",
                 "Shopee商品リスト (.xlsx) を読込",
                 "Shopeeは4行目〜データ / calamine使用",
             ]),
@@ -1051,7 +3336,7 @@ def main():
             ),
             (
                 "STEP 2 — 賞味期限の抽出",
-                "df['Sub Inventory'].apply(parse_expiry)\n"
+                "parse_expiry_column(df['Sub Inventory'])\n"
                 "# 正規表現: r'SS?_(\\d{6})$'",
                 "SELECT *,\n"
                 "  CASE\n"
@@ -1064,13 +3349,15 @@ def main():
             ),
             (
                 "STEP 3 — Shopee 掲載マッチング",
-                "# 3つのキーで LEFT JOIN 相当\n"
-                "is_on_shopee(row, sku_set, gtin_set, barcode_set)",
+                "# 4つのキーで LEFT JOIN 相当（isin によるハッシュ結合）\n"
+                "# gtin14_set は GTIN-14 に正規化したキー\n"
+                "match_shopee(df, sku_set, gtin_set, barcode_set, gtin14_set)",
                 "SELECT i.*,\n"
                 "  CASE\n"
                 "    WHEN s1.SKU IS NOT NULL       -- KEY1→SKU\n"
                 "      OR s2.GTIN IS NOT NULL      -- Code→GTIN\n"
                 "      OR s3.barcode IS NOT NULL   -- バーコード\n"
+                "      OR s4.gtin14 IS NOT NULL    -- GTIN正規化\n"
                 "    THEN TRUE ELSE FALSE\n"
                 "  END AS shopee_listed\n"
                 "FROM inventory_ec i\n"
@@ -1079,11 +3366,14 @@ def main():
                 "  LEFT JOIN shopee s2\n"
                 "    ON i.Product_Code = s2.GTIN\n"
                 "  LEFT JOIN shopee s3\n"
-                "    ON i.Product_Code = s3.barcode;",
+                "    ON i.Product_Code = s3.barcode\n"
+                "  LEFT JOIN shopee s4\n"
+                "    ON GTIN14(i.Product_Code) = s4.gtin14;",
             ),
             (
                 "STEP 4 — Product Code 集約",
-                "df.groupby('Product Code').agg(\n"
+                "# codes = factorize(Product Code)\n"
+                "df.groupby(codes).agg(\n"
                 "  商品名=('Product Name','first'),\n"
                 "  合計数量=('Total Piece Qty','sum'),\n"
                 "  最古入庫日=('Arrival Date','min'), ...)",
@@ -1152,29 +3442,37 @@ def main():
     # =========================================
     # 1. KPI カード
     # =========================================
-    total_sku = len(result)
-    shopee_count = int(result["Shopee掲載"].sum())
-    expiry_warn = int(((result["期限ステータス"] == "期限切れ") | (result["期限ステータス"] == "3ヶ月以内")).sum())
-    b2b_count = int(result["B2B候補"].sum())
-    render_kpi_cards(total_sku, shopee_count, expiry_warn, b2b_count)
+    # KPI・集計表・Excel のサマリ・Slack のメッセージはサマリキューブから求める
+    cube = st.session_state.get("summary_cube")
+    if cube is None or cube.fingerprint != fingerprint or fingerprint is None:
+        cube = SummaryCube(result, fingerprint)
+        st.session_state["summary_cube"] = cube
+    render_kpi_cards(**cube.kpis())
+    memory_report = st.session_state.get("memory_report")
+    if memory_report:
+        with st.expander("🧠 メモリ使用量（省メモリモード）"):
+            st.dataframe(pd.DataFrame(memory_report), use_container_width=True, hide_index=True)
+    gtin_report = st.session_state.get("gtin_report")
+    if gtin_report is not None and not gtin_report.empty:
+        with st.expander(f"🔢 GTIN として検証できなかったコード（{len(gtin_report):,}件）"):
+            st.caption(
+                "空白・小数表記を除いて 8〜14 桁の数字を GTIN-14 に揃え、チェックデジットを確かめています。"
+                "ここにあるコードは GTIN正規化 による Shopee 掲載判定の対象外です。"
+            )
+            st.dataframe(gtin_report, use_container_width=True, hide_index=True)
+            st.download_button(
+                "📥 一覧を CSV でダウンロード",
+                data=gtin_report.to_csv(index=False).encode("utf-8-sig"),
+                file_name="gtin_validation_report.csv",
+                mime="text/csv",
+                key="gtin_report_download",
+            )
 
     # =========================================
     # 2. Aging カテゴリ別集計
     # =========================================
     render_section_header("📈", "Aging カテゴリ別集計", "purple")
-    aging_summary = result.groupby("Agingカテゴリ", sort=False).agg(
-        SKU数=("Product Code", "count"),
-        Shopee掲載数=("Shopee掲載", "sum"),
-        合計数量=("合計数量", "sum"),
-        期限注意=("期限ステータス", lambda x: ((x == "期限切れ") | (x == "3ヶ月以内")).sum()),
-    ).reset_index()
-    aging_summary["Shopee掲載数"] = aging_summary["Shopee掲載数"].astype(int)
-    aging_summary["期限注意"] = aging_summary["期限注意"].astype(int)
-    aging_summary["構成比(%)"] = (aging_summary["SKU数"] / aging_summary["SKU数"].sum() * 100).round(1)
-    aging_summary["_sort"] = aging_summary["Agingカテゴリ"].apply(
-        lambda x: cat_order.index(x) if x in cat_order else 999
-    )
-    aging_summary = aging_summary.sort_values("_sort").drop(columns="_sort").reset_index(drop=True)
+    aging_summary = cube.aging_summary().rename(columns={"構成比": "構成比(%)"})
     st.dataframe(aging_summary, use_container_width=True, hide_index=True)
 
     # =========================================
@@ -1207,28 +3505,47 @@ def main():
     # =========================================
     render_section_header("📋", "商品別 Aging 明細", "blue")
 
-    filtered = result.copy()
-    filtered = filtered[filtered["Agingカテゴリ"].isin(aging_filter)]
-    if shopee_filter == "掲載あり":
-        filtered = filtered[filtered["Shopee掲載"]]
-    elif shopee_filter == "未掲載":
-        filtered = filtered[~filtered["Shopee掲載"]]
-    if b2b_filter == "候補のみ":
-        filtered = filtered[filtered["B2B候補"]]
-    elif b2b_filter == "候補外":
-        filtered = filtered[~filtered["B2B候補"]]
-
-    display_full = filtered.copy()
-    display_full["Shopee掲載"] = display_full["Shopee掲載"].map({True: "●", False: ""})
-    display_full["B2B候補"] = display_full["B2B候補"].map({True: "●", False: ""})
-    display_full["期限注意"] = display_full["期限ステータス"].apply(
-        lambda x: "⚠" if x in ("期限切れ", "3ヶ月以内") else ""
-    )
+    # 表示用フレームとフィルタのマスクは分析結果が変わったときだけ作り直す
+    detail_view = st.session_state.get("detail_view")
+    if detail_view is None or detail_view.fingerprint != fingerprint or fingerprint is None:
+        detail_view = DetailView(result, fingerprint)
+        st.session_state["detail_view"] = detail_view
+    display_full = detail_view.filter(aging_filter, shopee_filter, b2b_filter)
     st.dataframe(display_full, use_container_width=True, hide_index=True, height=500)
-    st.caption(f"表示中: {len(filtered):,}件 / 全{len(result):,}件")
+    shown = cube.totals(aging_filter, shopee_filter, b2b_filter)
+    st.caption(f"表示中: {shown['sku']:,}件（合計数量 {shown['qty']:,}） / 全{len(result):,}件")
 
     # =========================================
-    # 5. ダウンロード
+    # 5. 推移
+    # =========================================
+    render_section_header("📅", "推移", "purple")
+    try:
+        trend = load_snapshot_trend()
+    except sqlite3.Error as e:
+        trend = pd.DataFrame()
+        st.warning(f"履歴の読み込みに失敗しました: {e}")
+    if trend.empty:
+        st.caption("履歴はまだありません。分析を実行すると日付ごとに保存されます。")
+    else:
+        trend["日付"] = pd.to_datetime(trend["日付"])
+        trend_by = st.radio("集計軸", ["Agingカテゴリ", "期限ステータス"], horizontal=True, key="trend_by")
+        trend_metric = st.radio("指標", ["SKU数", "合計数量"], horizontal=True, key="trend_metric")
+        order = AGING_LABELS if trend_by == "Agingカテゴリ" else EXPIRY_STATUSES
+        pivot = trend.pivot_table(index="日付", columns=trend_by, values=trend_metric, aggfunc="sum", fill_value=0)
+        pivot = pivot[[c for c in order if c in pivot.columns]].rename(columns={"": "期限なし"})
+        st.line_chart(pivot)
+
+        history_code = st.text_input("Product Code の履歴", key="history_code").strip()
+        if history_code:
+            history = load_sku_history(history_code)
+            if history.empty:
+                st.caption(f"「{history_code}」の履歴はありません。")
+            else:
+                st.line_chart(history.set_index(pd.to_datetime(history["日付"]))["滞留日数"])
+                st.dataframe(history, use_container_width=True, hide_index=True)
+
+    # =========================================
+    # 6. ダウンロード
     # =========================================
     render_section_header("💾", "ダウンロード", "green")
     today_str = datetime.today().strftime("%Y%m%d")
@@ -1236,7 +3553,7 @@ def main():
     st.markdown('<div class="download-area">', unsafe_allow_html=True)
     dl1, dl2 = st.columns(2)
     with dl1:
-        excel_data = generate_excel(result)
+        excel_data = cached_export("excel", result, fingerprint, cube=cube)
         st.download_button(
             label="📥 Excel (.xlsx)",
             data=excel_data,
@@ -1246,12 +3563,16 @@ def main():
             use_container_width=True,
         )
     with dl2:
-        csv_data = generate_csv(result)
+        csv_gzip = st.checkbox(
+            "gzip で圧縮（.csv.gz）", key="csv_gzip",
+            help="大きな結果を保存・転送するとき用。スプレッドシートで開く前に解凍してください",
+        )
+        csv_data = cached_export("csv", result, fingerprint, compress=csv_gzip)
         st.download_button(
             label="📊 スプレッドシート用 CSV",
-            data=csv_data.encode("utf-8-sig"),
-            file_name=f"在庫Aging分析_{today_str}.csv",
-            mime="text/csv",
+            data=csv_data,
+            file_name=f"在庫Aging分析_{today_str}.csv" + (".gz" if csv_gzip else ""),
+            mime="application/gzip" if csv_gzip else "text/csv",
             use_container_width=True,
         )
     st.markdown(
@@ -1262,7 +3583,7 @@ def main():
     st.markdown("</div>", unsafe_allow_html=True)
 
     # =========================================
-    # 6. Slack 共有
+    # 7. Slack 共有
     # =========================================
     render_section_header("📤", "Slack に共有", "amber")
     if not slack_bot_token or not slack_channel_id:
@@ -1288,15 +3609,21 @@ def main():
                 unsafe_allow_html=True,
             )
         if share_btn:
-            with st.spinner("Slack にファイルを送信中..."):
-                excel_data = generate_excel(result)
-                ok, msg = send_slack_notification(
-                    slack_bot_token, slack_channel_id, result, excel_data,
-                )
+            # Excel の生成だけを待ち、アップロードはバックグラウンドの送信ワーカーに任せる
+            with st.spinner("Excel を準備中..."):
+                excel_data = cached_export("excel", result, fingerprint, cube=cube)
+            ok, msg, job_id = queue_slack_notification(
+                slack_bot_token, slack_channel_id, result, excel_data, cube=cube,
+            )
             if ok:
+                # 送信状況には、このセッションが送信したジョブだけを出す
+                st.session_state.setdefault("slack_job_ids", []).append(job_id)
                 st.success(msg)
             else:
                 st.error(msg)
+        render_slack_jobs(slack_worker(), st.session_state.get("slack_job_ids", []))
+
+    render_perf_panel(_active_timer.get())
 
     # フッター
     st.markdown(
@@ -1307,5 +3634,19 @@ def main():
     )
 
 
+def main():
+    """画面を描画し、その間に計測した段階を「パフォーマンス」パネルと JSON ログに出す。"""
+    timer = StageTimer()
+    token = _active_timer.set(timer)
+    try:
+        render_app()
+    finally:
+        _active_timer.reset(token)
+        if timer.records:
+            st.session_state["perf_records"] = timer.records
+            st.session_state["perf_context"] = timer.context
+            log_perf(timer)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,70 @@
+"""
+parse_expiry（行ごとの apply）と parse_expiry_column（ユニーク値のみ解析）の比較ベンチマーク
+
+    python bench/bench_parse_expiry.py --rows 300000 --unique 300
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import parse_expiry, parse_expiry_column  # noqa: E402
+
+
+def make_sub_inventory(rows: int, unique: int, seed: int = 0) -> pd.Series:
+    """SS_yymmdd 形式を中心に、不正日付・期限なしを混ぜた Sub Inventory 列を作る。"""
+    rng = np.random.default_rng(seed)
+    base = pd.Timestamp("2025-01-01")
+    values = []
+    for i in range(unique):
+        kind = i % 10
+        if kind == 0:
+            values.append(f"SS_{rng.integers(24, 30):02d}13{rng.integers(1, 29):02d}")  # 不正な月
+        elif kind == 1:
+            values.append(f"LOC-{i:04d}")
+        else:
+            d = base + pd.Timedelta(days=int(rng.integers(0, 1500)))
+            prefix = "S" if kind == 2 else "SS"
+            values.append(f"{prefix}_{d.strftime('%y%m%d')}")
+    return pd.Series(rng.choice(np.array(values, dtype=object), rows))
+
+
+def _best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=300_000)
+    parser.add_argument("--unique", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sub_inv = make_sub_inventory(args.rows, args.unique)
+
+    old = sub_inv.apply(parse_expiry).astype("datetime64[us]")
+    new = parse_expiry_column(sub_inv)
+    if not old.equals(new):
+        raise SystemExit("parse_expiry と parse_expiry_column の結果が一致しません")
+
+    t_old = _best_of(lambda: sub_inv.apply(parse_expiry), args.repeat)
+    t_new = _best_of(lambda: parse_expiry_column(sub_inv), args.repeat)
+    print(f"rows={args.rows:,} unique={args.unique:,}")
+    print(f"  parse_expiry (apply)   : {t_old * 1000:10.1f} ms")
+    print(f"  parse_expiry_column    : {t_new * 1000:10.1f} ms")
+    print(f"  speedup                : {t_old / t_new:10.1f} x")
+
+
+if __name__ == "__main__":
+    main()
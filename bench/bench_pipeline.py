@@ -0,0 +1,183 @@
+"""
+読み込みから出力までの各段階を計測するベンチマーク
+
+    python bench/bench_pipeline.py --sizes 10000 100000 1000000
+    python bench/bench_pipeline.py --sizes 100000 --baseline bench/results/前回.json
+
+bench/synthetic.py で在庫リストと Shopee 商品リストを生成し（bench/data に保存して再利用）、
+load_inventory / load_inventory_streaming / load_shopee_files / run_analysis /
+generate_excel / generate_csv / _build_summary_text の実行時間と tracemalloc のピークメモリを JSON に書き出す。
+読込キャッシュは一時ディレクトリに向け、計測ごとに空にする。
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+# app の import より前に、キャッシュ・履歴の保存先を一時ディレクトリへ向ける
+_work_dir = tempfile.mkdtemp(prefix="inventory-bench-")
+for _name, _path in [
+    ("PARSE_DISK_CACHE_DIR", "parsed"),
+    ("SNAPSHOT_DB_PATH", "snapshots.sqlite3"),
+    ("SHOPEE_CATALOG_DB_PATH", "shopee_catalog.sqlite3"),
+]:
+    os.environ.setdefault(_name, os.path.join(_work_dir, _path))
+
+import pandas as pd  # noqa: E402
+
+import app  # noqa: E402
+from synthetic import generate_files  # noqa: E402
+
+STAGES = [
+    "load_inventory", "load_inventory_streaming", "load_shopee_files", "run_analysis",
+    "generate_excel", "generate_csv", "_build_summary_text",
+]
+
+
+def _timed(func) -> tuple[object, float]:
+    app.clear_parse_caches()
+    gc.collect()
+    t0 = time.perf_counter()
+    value = func()
+    return value, time.perf_counter() - t0
+
+
+def _peak_memory_mb(func) -> float:
+    """tracemalloc で追跡した Python 側（numpy を含む）のピーク割り当て量。
+
+    tracemalloc は実行を遅くするため、時間の計測とは別に1回だけ実行する。
+    """
+    app.clear_parse_caches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024 / 1024, 1)
+
+
+def bench_size(rows: int, data_dir: str, shops: int, repeat: int, memory: bool = True) -> list[dict]:
+    inv_path, shopee_paths = generate_files(rows, data_dir, shops=shops)
+
+    def load_shopee():
+        files = [open(p, "rb") for p in shopee_paths]
+        try:
+            return app.load_shopee_files(files)
+        finally:
+            for f in files:
+                f.close()
+
+    results = []
+    values = {}
+    steps = {
+        "load_inventory": lambda: app.load_inventory(inv_path),
+        "load_inventory_streaming": lambda: app.load_inventory_streaming(inv_path),
+        "load_shopee_files": load_shopee,
+        "run_analysis": lambda: app.run_analysis(values["load_inventory"], values["load_shopee_files"]),
+        "generate_excel": lambda: app.generate_excel(values["run_analysis"]),
+        "generate_csv": lambda: app.generate_csv(values["run_analysis"]),
+        "_build_summary_text": lambda: app._build_summary_text(values["run_analysis"]),
+    }
+    for stage in STAGES:
+        runs = []
+        for _ in range(repeat):
+            values[stage], seconds = _timed(steps[stage])
+            runs.append(round(seconds, 4))
+        peak_mb = _peak_memory_mb(steps[stage]) if memory else None
+        results.append({
+            "rows": rows,
+            "stage": stage,
+            "seconds": min(runs),
+            "runs": runs,
+            "peak_mb": peak_mb,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        })
+        peak = f"{peak_mb:>10.1f} MB" if memory else ""
+        print(f"  {stage:<26}{min(runs):>10.3f} s{peak}", flush=True)
+    results.append({
+        "rows": rows, "stage": "result_rows",
+        "inventory_rows": len(values["load_inventory"]),
+        "shopee_rows": len(values["load_shopee_files"]),
+        "sku": len(values["run_analysis"]),
+    })
+    return results
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: list[dict], baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {
+            (r["rows"], r["stage"]): r for r in json.load(f)["results"] if "seconds" in r
+        }
+    print(f"\nbaseline: {baseline_path}")
+    for r in results:
+        base = baseline.get((r["rows"], r["stage"]))
+        if base is None or "seconds" not in r:
+            continue
+        ratio = base["seconds"] / r["seconds"] if r["seconds"] else float("inf")
+        print(f"  {r['rows']:>9,} {r['stage']:<26}{base['seconds']:>10.3f} s -> {r['seconds']:>8.3f} s ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--shops", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true", help="tracemalloc によるピークメモリの計測を省く")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "data"))
+    parser.add_argument("--out", default=None, help="結果 JSON（省略時は bench/results/<日時>.json）")
+    parser.add_argument("--baseline", default=None, help="比較する過去の結果 JSON")
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.sizes:
+        print(f"rows={rows:,}", flush=True)
+        results.extend(bench_size(rows, args.data_dir, args.shops, args.repeat, memory=not args.no_memory))
+
+    out = args.out or os.path.join(BENCH_DIR, "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "shops": args.shops,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果: {out}")
+    if args.baseline:
+        print_comparison(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
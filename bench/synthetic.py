@@ -0,0 +1,208 @@
+"""
+ベンチマーク用の在庫リスト・Shopee 商品リストを生成する
+
+    python bench/synthetic.py --rows 100000 --out bench/data
+
+キーの分布（PICKING KEY7 の内訳、SS_yymmdd の割合、先頭 0 付きコードの割合、
+Shopee 掲載率）は引数で変えられる。同じ seed なら同じデータになる。
+"""
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+# PICKING KEY7 の既定の内訳（前後の空白・小文字・欠損を含む）
+DEFAULT_KEY7_MIX = {"EC": 0.55, " ec ": 0.05, "B2B": 0.2, "": 0.1, None: 0.1}
+
+# 分析に使わない列（列の絞り込みの効果を見るために在庫リストへ混ぜる）
+EXTRA_INVENTORY_COLUMNS = ["Warehouse", "Location", "Lot No", "Supplier", "Remarks"]
+
+
+def _probabilities(mix: dict) -> tuple[list, np.ndarray]:
+    keys = list(mix)
+    weights = np.array([mix[k] for k in keys], dtype=float)
+    return keys, weights / weights.sum()
+
+
+def make_product_codes(products: int, leading_zero_ratio: float = 0.15, seed: int = 0) -> np.ndarray:
+    """13 桁の JAN 風コード。leading_zero_ratio の割合で先頭を 0 にする。"""
+    rng = np.random.default_rng(seed)
+    numbers = rng.choice(10**12, products, replace=False) + 10**12
+    codes = np.array([f"{n:013d}" for n in numbers], dtype=object)
+    zeros = rng.random(products) < leading_zero_ratio
+    codes[zeros] = ["00" + c[2:] for c in codes[zeros]]
+    return codes
+
+
+def make_sub_inventory(rows: int, expiry_ratio: float = 0.7, invalid_ratio: float = 0.02, seed: int = 0) -> np.ndarray:
+    """SS_yymmdd / S_yymmdd を中心に、存在しない日付と期限なしのロケーションを混ぜる。"""
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize()
+    offsets = rng.integers(-365, 3 * 365, rows)
+    dates = (today + pd.to_timedelta(offsets, unit="D")).strftime("%y%m%d").to_numpy(dtype=object)
+    prefixes = rng.choice(np.array(["SS_", "S_"], dtype=object), rows, p=[0.8, 0.2])
+    values = prefixes + dates
+    draw = rng.random(rows)
+    values[draw >= expiry_ratio] = rng.choice(
+        np.array(["MAIN", "RETURN", "QC-HOLD", "B2B-01"], dtype=object), int((draw >= expiry_ratio).sum()),
+    )
+    invalid = draw < expiry_ratio * invalid_ratio
+    values[invalid] = [f"SS_{y:02d}1332" for y in rng.integers(24, 30, int(invalid.sum()))]
+    return values
+
+
+def make_inventory(
+    rows: int,
+    products: int | None = None,
+    key7_mix: dict | None = None,
+    expiry_ratio: float = 0.7,
+    leading_zero_ratio: float = 0.15,
+    sku_key_ratio: float = 0.6,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """在庫リスト（1 行 = 1 ロット）。products を省略すると rows の 1/4 の商品数にする。"""
+    rng = np.random.default_rng(seed)
+    products = products or max(rows // 4, 10)
+    catalog = make_product_codes(products, leading_zero_ratio, seed)
+    picked = rng.integers(0, products, rows)
+    codes = catalog[picked]
+
+    # PICKING KEY1 は Shopee の SKU（prefix_barcode_suffix）かコードそのもの
+    prefixes = np.array(["TH", "MY", "SG", "PH"], dtype=object)[picked % 4]
+    key1 = np.where(
+        rng.random(rows) < sku_key_ratio,
+        prefixes + "_" + codes + "_" + (picked % 3).astype(str).astype(object),
+        codes,
+    )
+    keys, p = _probabilities(key7_mix or DEFAULT_KEY7_MIX)
+    key7 = np.array(keys, dtype=object)[rng.choice(len(keys), rows, p=p)]
+
+    today = pd.Timestamp.today().normalize()
+    arrival = today - pd.to_timedelta(rng.gamma(2.0, 90.0, rows).astype(int), unit="D")
+    df = pd.DataFrame({
+        "Product Code": codes,
+        "Product Name": np.array([f"商品 {c[-6:]}" for c in catalog], dtype=object)[picked],
+        "PICKING KEY1": key1,
+        "PICKING KEY7": key7,
+        "Arrival Date": arrival,
+        "Sub Inventory": make_sub_inventory(rows, expiry_ratio, seed=seed),
+        "Total Piece Qty": rng.integers(1, 200, rows),
+        "Case Qty": rng.integers(0, 10, rows),
+        "Total Weight": np.round(rng.random(rows) * 25, 3),
+        "Total Volume": np.round(rng.random(rows) * 0.2, 4),
+    })
+    df.loc[rng.random(rows) < 0.01, "Arrival Date"] = pd.NaT
+    for i, col in enumerate(EXTRA_INVENTORY_COLUMNS):
+        df[col] = np.array([f"{col[:3].upper()}-{j:03d}" for j in range(50)], dtype=object)[
+            rng.integers(0, 50, rows)
+        ]
+    return df
+
+
+def make_shopee(
+    inventory: pd.DataFrame,
+    coverage: float = 0.3,
+    shops: int = 4,
+    noise_ratio: float = 0.2,
+    seed: int = 0,
+) -> list[pd.DataFrame]:
+    """在庫の商品のうち coverage の割合を掲載した、ショップごとの Shopee 商品リスト。
+
+    SKU は prefix_barcode_suffix 形式で、在庫の PICKING KEY1 と同じ SKU・バーコードだけが
+    一致する SKU（半数は先頭 0 を落とす）・GTIN 列のみ、の3通りを混ぜる。
+    noise_ratio の割合で在庫にない商品も混ぜる。
+    """
+    rng = np.random.default_rng(seed)
+    codes = pd.unique(inventory["Product Code"].dropna())
+    listed = rng.choice(codes, int(len(codes) * coverage), replace=False)
+    noise = np.array([f"{n:013d}" for n in rng.integers(10**12, 10**13, int(len(listed) * noise_ratio))], dtype=object)
+    listed = np.concatenate([listed, noise])
+    has_sku = inventory["PICKING KEY1"].str.contains("_", na=False)
+    sku_by_code = inventory.loc[has_sku].drop_duplicates("Product Code").set_index("Product Code")["PICKING KEY1"]
+    inventory_skus = sku_by_code.reindex(listed).to_numpy(dtype=object)
+    draw = rng.random(len(listed))
+    by_gtin = draw < 0.2
+    by_key1 = (draw >= 0.6) & pd.notna(inventory_skus)
+    barcodes = np.array([c.lstrip("0") if d < 0.4 else c for c, d in zip(listed, draw)], dtype=object)
+    frames = []
+    for shop, part in enumerate(np.array_split(rng.permutation(len(listed)), shops)):
+        n = len(part)
+        frames.append(pd.DataFrame({
+            "Product ID": np.arange(n) + shop * 10**8,
+            "Product Name": [f"Shopee 商品 {c[-6:]}" for c in listed[part]],
+            "Variation ID": np.arange(n),
+            "Variation Name": "",
+            "Parent SKU": "",
+            "SKU": np.where(
+                by_gtin[part], "", np.where(by_key1[part], inventory_skus[part], "S" + str(shop) + "_" + barcodes[part] + "_01"),
+            ),
+            "Price": np.round(rng.random(n) * 500, 2),
+            "GTIN": np.where(by_gtin[part], listed[part], ""),
+            "Stock": rng.integers(0, 100, n),
+            "Min Purchase Qty": 1,
+            "Fail Reason": "",
+        }))
+    return frames
+
+
+def write_inventory_xlsx(df: pd.DataFrame, path: str):
+    """在庫リストを 1 シートの xlsx に書く（write_only で行ごとに出力）。"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Inventory")
+    ws.append(list(df.columns))
+    columns = [df[c].astype(object).where(df[c].notna(), None).tolist() for c in df.columns]
+    for row in zip(*columns):
+        ws.append(row)
+    wb.save(path)
+
+
+def write_shopee_xlsx(df: pd.DataFrame, path: str):
+    """Shopee 管理画面のエクスポートと同じく、3 行の見出しの後にデータを置く。"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(["mass_update_basic_info"])
+    ws.append(list(df.columns))
+    ws.append(["Required" if c in ("Product ID", "SKU") else "Optional" for c in df.columns])
+    columns = [df[c].astype(object).tolist() for c in df.columns]
+    for row in zip(*columns):
+        ws.append(row)
+    wb.save(path)
+
+
+def generate_files(rows: int, out_dir: str, shops: int = 4, seed: int = 0, **options) -> tuple[str, list[str]]:
+    """在庫リストと Shopee 商品リストを out_dir に書き出す。同じ条件のファイルがあれば再利用する。"""
+    os.makedirs(out_dir, exist_ok=True)
+    stem = f"rows{rows}_seed{seed}"
+    if options:
+        stem += "_" + hashlib.sha1(repr(sorted(options.items(), key=str)).encode()).hexdigest()[:8]
+    inv_path = os.path.join(out_dir, f"inventory_{stem}.xlsx")
+    shopee_paths = [os.path.join(out_dir, f"shopee_{stem}_shop{i}.xlsx") for i in range(shops)]
+    if os.path.exists(inv_path) and all(os.path.exists(p) for p in shopee_paths):
+        return inv_path, shopee_paths
+
+    inventory = make_inventory(rows, seed=seed, **options)
+    for path, frame in zip(shopee_paths, make_shopee(inventory, shops=shops, seed=seed)):
+        write_shopee_xlsx(frame, path)
+    write_inventory_xlsx(inventory, inv_path)
+    return inv_path, shopee_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--shops", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    args = parser.parse_args()
+    inv_path, shopee_paths = generate_files(args.rows, args.out, shops=args.shops, seed=args.seed)
+    print(inv_path)
+    for path in shopee_paths:
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
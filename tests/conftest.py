@@ -0,0 +1,21 @@
+"""
+テスト共通の設定
+
+app の import より前に、キャッシュ・履歴・送信待ちの保存先を一時ディレクトリへ向ける。
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+_work_dir = tempfile.mkdtemp(prefix="inventory-test-")
+for _name, _path in [
+    ("PARSE_DISK_CACHE_DIR", "parsed"),
+    ("SNAPSHOT_DB_PATH", "snapshots.sqlite3"),
+    ("SHOPEE_CATALOG_DB_PATH", "shopee_catalog.sqlite3"),
+    ("SLACK_OUTBOX_DB_PATH", "slack_outbox.sqlite3"),
+]:
+    os.environ.setdefault(_name, os.path.join(_work_dir, _path))
@@ -0,0 +1,84 @@
+"""GTIN の正規化（canonical_gtin_column / canonical_gtin）と検証エラーの一覧。"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("code, expected", [
+    # EAN-13 / JAN
+    ("4006381333931", "04006381333931"),
+    ("4901234567894", "04901234567894"),
+    # UPC-A（Excel で先頭の 0 が落ちた 11 桁を含む）
+    ("036000291452", "00036000291452"),
+    ("36000291452", "00036000291452"),
+    # GTIN-8
+    ("96385074", "00000096385074"),
+    # GTIN-14
+    ("10012345678902", "10012345678902"),
+    ("04006381333931", "04006381333931"),
+    # 空白・ハイフン・Excel の小数や指数の表記
+    (" 4006381 333931 ", "04006381333931"),
+    ("4006-3813-33931", "04006381333931"),
+    ("4006381333931.0", "04006381333931"),
+    ("4.006381333931E+12", "04006381333931"),
+    ("4.006381333931e12", "04006381333931"),
+    (4006381333931.0, "04006381333931"),
+    (36000291452, "00036000291452"),
+])
+def test_valid_codes_share_one_key(code, expected):
+    assert app.canonical_gtin(code) == expected
+
+
+@pytest.mark.parametrize("code, reason", [
+    ("4006381333932", "チェックデジット不一致"),
+    ("036000291453", "チェックデジット不一致"),
+    ("96385075", "チェックデジット不一致"),
+    ("10012345678903", "チェックデジット不一致"),
+    ("4006381333931.5", "数字以外を含む"),
+    ("SKU-ABC", "数字以外を含む"),
+    ("1234567", "桁数が 8〜14 桁でない"),
+    ("123456789012345", "桁数が 8〜14 桁でない"),
+])
+def test_invalid_codes_report_a_reason(code, reason):
+    checked = app.canonical_gtin_column(pd.Series([code], dtype=object))
+    assert pd.isna(checked["gtin"].iloc[0])
+    assert checked["reason"].iloc[0] == reason
+    assert app.canonical_gtin(code) is None
+
+
+def test_blank_and_missing_codes_have_no_reason():
+    checked = app.canonical_gtin_column(pd.Series(["", "  ", None, np.nan], dtype=object))
+    assert checked["gtin"].isna().all()
+    assert checked["reason"].tolist() == ["", "", "", ""]
+
+
+def test_all_missing_column():
+    values = pd.Series([np.nan, np.nan], index=[10, 20])
+    checked = app.canonical_gtin_column(values)
+    assert checked.index.tolist() == [10, 20]
+    assert checked["gtin"].isna().all()
+    assert checked["reason"].tolist() == ["", ""]
+
+
+def test_column_expands_unique_values_to_every_row():
+    values = pd.Series(["4006381333931", "4006381333931.0", "x", "4006381333931"], index=[3, 1, 2, 0])
+    checked = app.canonical_gtin_column(values)
+    assert checked.index.tolist() == [3, 1, 2, 0]
+    assert checked["gtin"].tolist()[:2] == ["04006381333931", "04006381333931"]
+    assert checked["gtin"].iloc[3] == "04006381333931"
+    assert checked["reason"].tolist() == ["", "", "数字以外を含む", ""]
+
+
+def test_validation_report_lists_failed_codes_by_source():
+    shopee = pd.DataFrame({c: "" for c in app.SHOPEE_COLUMNS}, index=range(2))
+    shopee["SKU"] = ["TH_4006381333932_01", "S1_036000291452_01"]
+    shopee["GTIN"] = ["96385075", ""]
+    report = app.gtin_validation_report(pd.Series(["4006381333931", "ABC", "ABC", ""]), shopee)
+    assert report[["区分", "コード", "理由", "件数"]].values.tolist() == [
+        ["在庫 Product Code", "ABC", "数字以外を含む", 2],
+        ["Shopee GTIN", "96385075", "チェックデジット不一致", 1],
+        ["Shopee SKU のバーコード", "4006381333932", "チェックデジット不一致", 1],
+    ]
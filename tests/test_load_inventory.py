@@ -0,0 +1,51 @@
+"""在庫リストの読み込み経路（calamine の高速パス・openpyxl への切り替え・行単位）でキーが揃うこと。"""
+
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture
+def inventory_path(tmp_path):
+    df = pd.DataFrame({
+        "Product Code": ["0231612397731", "4901234567894", "00012345"],
+        "Product Name": ["a", "b", "c"],
+        "PICKING KEY1": ["0231612397731", "TH_04901234567894_01", "00012345"],
+        "PICKING KEY7": ["EC", "EC", "EC"],
+        "Arrival Date": pd.Timestamp("2026-01-15"),
+        "Sub Inventory": ["SS_270101", "MAIN", "S_280202"],
+        "Total Piece Qty": [1, 2, 3],
+        "Case Qty": 0,
+        "Total Weight": 0.5,
+        "Total Volume": 0.01,
+    })
+    path = tmp_path / "inventory.xlsx"
+    df.to_excel(path, index=False)
+    return str(path)
+
+
+def _keys(df: pd.DataFrame) -> list:
+    return df[["Product Code", "PICKING KEY1"]].astype(object).values.tolist()
+
+
+def test_openpyxl_fallback_keeps_leading_zeros(inventory_path, monkeypatch):
+    app.clear_parse_caches()
+    fast = app.load_inventory(inventory_path)
+
+    def unavailable(file):
+        raise RuntimeError("calamine unavailable")
+
+    monkeypatch.setattr(app, "_read_inventory_fast", unavailable)
+    app.clear_parse_caches()
+    fallback = app.load_inventory(inventory_path)
+    streaming = app.load_inventory_streaming(inventory_path)
+
+    expected = [
+        ["0231612397731", "0231612397731"],
+        ["4901234567894", "TH_04901234567894_01"],
+        ["00012345", "00012345"],
+    ]
+    assert _keys(fast) == expected
+    assert _keys(fallback) == expected
+    assert _keys(streaming) == expected
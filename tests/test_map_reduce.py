@@ -0,0 +1,77 @@
+"""複数ファイルの map-reduce（run_analysis_files）が、全明細をまとめた run_analysis と一致すること。"""
+
+import pandas as pd
+import pytest
+
+import app
+
+
+def _inventory(codes: list, sub_inventory: list) -> pd.DataFrame:
+    n = len(codes)
+    return pd.DataFrame({
+        "Product Code": codes,
+        "Product Name": [f"商品 {c}" for c in codes],
+        "PICKING KEY1": codes,
+        "PICKING KEY7": ["EC"] * n,
+        "Arrival Date": pd.Timestamp("2026-01-15"),
+        "Sub Inventory": sub_inventory,
+        "Total Piece Qty": range(1, n + 1),
+        "Case Qty": 1,
+        "Total Weight": 0.5,
+        "Total Volume": 0.01,
+    })
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_blank_product_code_does_not_leak_expiry(tmp_path, workers):
+    frames = [
+        # Product Code が空欄の明細にだけ賞味期限がある
+        _inventory(["A1", None], ["SS_270101", "SS_280505"]),
+        _inventory(["Z9", "A1"], ["MAIN", "SS_270301"]),
+    ]
+    paths = []
+    for i, frame in enumerate(frames):
+        path = tmp_path / f"warehouse{i}.xlsx"
+        frame.to_excel(path, index=False)
+        paths.append(str(path))
+
+    expected = app.run_analysis(pd.concat(frames, ignore_index=True), None)
+    result = app.run_analysis_files(paths, None, workers=workers)
+
+    assert result.set_index("Product Code").loc["Z9", "期限一覧"] == ""
+    pd.testing.assert_frame_equal(
+        result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False,
+    )
+
+
+def _write(path, frame: pd.DataFrame) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frame.to_excel(path, index=False)
+    return str(path)
+
+
+def test_same_file_names_get_distinct_warehouse_labels(tmp_path):
+    paths = [
+        _write(tmp_path / "tokyo" / "inventory.xlsx", _inventory(["A1"], ["MAIN"])),
+        _write(tmp_path / "osaka" / "inventory.xlsx", _inventory(["A1", "B2"], ["MAIN", "MAIN"])),
+    ]
+    result = app.run_analysis_files(paths, None, warehouse_breakdown=True, workers=1).set_index("Product Code")
+
+    assert result.loc["A1", "倉庫別数量"] == "inventory: 1 / inventory (2): 1"
+    assert result.loc["B2", "倉庫別数量"] == "inventory (2): 2"
+
+
+def test_lean_run_reports_memory_per_file_and_after_merge(tmp_path):
+    paths = [
+        _write(tmp_path / "east.xlsx", _inventory(["A1", "B2"], ["MAIN", "SS_270101"])),
+        _write(tmp_path / "west.xlsx", _inventory(["A1"], ["MAIN"])),
+    ]
+    memory_report = []
+    app.run_analysis_files(paths, None, lean=True, workers=1, memory_report=memory_report)
+
+    assert [r["段階"] for r in memory_report] == [
+        "入力（east）", "明細（east）", "部分集計（east）",
+        "入力（west）", "明細（west）", "部分集計（west）",
+        "集計", "結果",
+    ]
+    assert memory_report[-1]["行数"] == 2
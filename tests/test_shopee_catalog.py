@@ -0,0 +1,73 @@
+"""ShopeeCatalog がショップごとに最新のエクスポートだけで判定すること。"""
+
+import pandas as pd
+import pytest
+
+import app
+
+
+def _export(skus, shop=None):
+    df = pd.DataFrame({c: None for c in app.SHOPEE_COLUMNS}, index=range(len(skus)))
+    df["Product ID"] = range(len(skus))
+    df["SKU"] = skus
+    if shop is not None:
+        df["Shop"] = shop
+    return df
+
+
+def _listed_skus(catalog, skus):
+    inventory = pd.DataFrame({"PICKING KEY1": skus})
+    return catalog.lookup_sets(inventory)[0]
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return app.ShopeeCatalog(str(tmp_path / "catalog.sqlite3"))
+
+
+def test_newer_export_drops_delisted_keys(catalog):
+    catalog.upsert(_export(["A", "B"], "TH本店"), seen_date="2026-10-01")
+    catalog.upsert(_export(["A"], "TH本店"), seen_date="2026-10-02")
+    assert _listed_skus(catalog, ["A", "B"]) == {"A"}
+    assert catalog.stats() == {"entries": 1, "shops": 1, "last_seen": "2026-10-02"}
+
+
+def test_same_day_reupload_replaces_keys(catalog):
+    catalog.upsert(_export(["A", "B"], "TH本店"), seen_date="2026-10-01")
+    catalog.upsert(_export(["B"], "TH本店"), seen_date="2026-10-01")
+    assert _listed_skus(catalog, ["A", "B"]) == {"B"}
+
+
+def test_other_shops_are_kept(catalog):
+    catalog.upsert(_export(["A"], "TH本店"), seen_date="2026-10-01")
+    catalog.upsert(_export(["B"], "MY店"), seen_date="2026-10-02")
+    catalog.upsert(_export(["C"], "TH本店"), seen_date="2026-10-03")
+    assert _listed_skus(catalog, ["A", "B", "C"]) == {"B", "C"}
+
+
+def test_rows_without_shop_are_not_stored(catalog):
+    catalog.upsert(_export(["A"], "TH本店"), seen_date="2026-10-01")
+    catalog.upsert(_export(["B"], ""), seen_date="2026-10-02")
+    assert _listed_skus(catalog, ["A", "B"]) == {"A"}
+    assert catalog.stats()["shops"] == 1
+
+
+def test_shop_comes_from_input_not_file_name(tmp_path):
+    # 同じショップのエクスポートをファイル名を変えて取り込んでも、同じショップとして置き換わる
+    files = []
+    for name, skus in [("export_1001.xlsx", ["A", "B"]), ("mass_update_TH.xlsx", ["A"])]:
+        path = tmp_path / name
+        export = _export(skus)
+        export["Fail Reason"] = "-"
+        with pd.ExcelWriter(path) as writer:
+            pd.DataFrame([[None]] * 3).to_excel(writer, header=False, index=False)
+            export.to_excel(writer, header=False, index=False, startrow=3)
+        files.append(path)
+    catalog = app.ShopeeCatalog(str(tmp_path / "catalog.sqlite3"))
+    for path in files:
+        with open(path, "rb") as f:
+            shopee = app.load_shopee_files([f], workers=1, shops=[" TH本店 "])
+        assert set(shopee["Shop"]) == {"TH本店"}
+        catalog.upsert(shopee)
+    assert _listed_skus(catalog, ["A", "B"]) == {"A"}
+    assert catalog.stats()["shops"] == 1
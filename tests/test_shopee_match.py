@@ -0,0 +1,73 @@
+"""Shopee 掲載判定の一致ルール（match_reason / 一致ルール）が is_on_shopee の判定順と一致すること。"""
+
+import pandas as pd
+import pytest
+
+import app
+from bench.synthetic import make_inventory, make_shopee
+
+
+@pytest.fixture(scope="module")
+def inputs():
+    inventory = make_inventory(400, seed=3)
+    shopee = pd.concat(make_shopee(inventory, shops=2, seed=3), ignore_index=True)
+    # 同じ商品を GTIN-14・UPC-A・小数表記で書いた明細（GTIN正規化 でだけ一致する）と、
+    # KEY1→SKU とバーコードで一致する明細を1つずつ持つ商品
+    extra = pd.DataFrame({
+        "Product Code": ["4006381333931.0", "36000291452", "096385074", "4006381333931", "4006381333931"],
+        "Product Name": ["x", "y", "z", "x", "x"],
+        "PICKING KEY1": ["K1", "K2", "K3", "K4", "TH_4006381333931_1"],
+        "PICKING KEY7": "EC",
+        "Arrival Date": pd.Timestamp("2026-01-15"),
+        "Sub Inventory": "MAIN",
+        "Total Piece Qty": 1,
+        "Case Qty": 0,
+        "Total Weight": 0.0,
+        "Total Volume": 0.0,
+    })
+    listed = pd.DataFrame({c: "" for c in app.SHOPEE_COLUMNS}, index=range(4))
+    listed["SKU"] = ["", "", "", "TH_4006381333931_1"]
+    listed["GTIN"] = ["04006381333931", "036000291452", "96385074", ""]
+    inventory = pd.concat([inventory, extra], ignore_index=True)
+    inventory["PICKING KEY7"] = "EC"
+    return inventory, pd.concat([shopee, listed], ignore_index=True)
+
+
+def _reference_reasons(df: pd.DataFrame, shopee: pd.DataFrame) -> list:
+    """ルールを1つずつ is_on_shopee に渡し、判定順で最初に一致したルールを返す。"""
+    sets = app.build_shopee_sets(shopee)
+    reasons = []
+    for _, row in df.iterrows():
+        reason = ""
+        for i, label in enumerate(app.SHOPEE_MATCH_REASONS):
+            only = [s if j == i else set() for j, s in enumerate(sets)]
+            if app.is_on_shopee(row, *only):
+                reason = label
+                break
+        assert (reason != "") == app.is_on_shopee(row, *sets)
+        reasons.append(reason)
+    return reasons
+
+
+def test_lot_reasons_match_is_on_shopee(inputs):
+    inventory, shopee = inputs
+    lots = app.prepare_lots(inventory, shopee)
+    expected = _reference_reasons(lots, shopee)
+
+    assert lots["match_reason"].astype(str).tolist() == expected
+    assert set(expected) == set(app.SHOPEE_MATCH_REASONS) | {""}
+
+
+def test_product_reason_is_highest_priority_lot_reason(inputs):
+    inventory, shopee = inputs
+    lots = app.prepare_lots(inventory, shopee)
+    rank = {label: i for i, label in enumerate(app.SHOPEE_MATCH_REASONS + [""])}
+    lots["rank"] = [rank[r] for r in _reference_reasons(lots, shopee)]
+    best = lots.groupby("Product Code")["rank"].min().map(dict(enumerate(app.SHOPEE_MATCH_REASONS + [""])))
+
+    result = app.run_analysis(inventory, shopee).set_index("Product Code")
+    assert result["一致ルール"].astype(str).to_dict() == best.to_dict()
+    assert ((result["一致ルール"] != "") == result["Shopee掲載"]).all()
+    # 4006381333931 は バーコード と KEY1→SKU の明細があり、判定順で先の KEY1→SKU になる
+    assert result.loc["4006381333931", "一致ルール"] == "KEY1→SKU"
+    assert result.loc["4006381333931.0", "一致ルール"] == "GTIN正規化"